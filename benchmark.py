@@ -0,0 +1,263 @@
+#!python
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import statistics
+import sys
+import time
+
+import numpy as np
+
+import portfolio_value as pv
+import tourney_utils as tourney
+import trade_optimizer
+
+SIZES = [64, 68, 256, 1024]
+
+
+# Bracket, ratings and positions for a made-up field of num_teams teams. The
+# largest power of two at or below num_teams gives the leaves and the rest of
+# the teams are play-ins, paired with the last leaves as in the real field.
+def synthetic_tournament(num_teams, seed=0):
+    rng = np.random.default_rng(seed)
+    num_leaves = 1 << (num_teams.bit_length() - 1)
+    num_play_ins = num_teams - num_leaves
+
+    ratings = tourney.Ratings()
+    names = ["Team {0:04d}".format(i) for i in range(num_teams)]
+    for name, offense, defense, tempo in zip(
+        names,
+        rng.normal(106.0, 6.0, num_teams),
+        rng.normal(103.0, 6.0, num_teams),
+        rng.normal(67.7, 3.0, num_teams),
+    ):
+        ratings[name] = tourney.Team(name, offense, defense, tempo, adjust=True)
+
+    bracket = [{name: 1.0} for name in names[: num_leaves - num_play_ins]]
+    for k in range(num_play_ins):
+        team1 = names[num_leaves - num_play_ins + 2 * k]
+        team2 = names[num_leaves - num_play_ins + 2 * k + 1]
+        win_prob = tourney.calculate_win_prob(ratings[team1], ratings[team2])
+        bracket.append({team1: win_prob, team2: 1 - win_prob})
+
+    num_rounds = num_leaves.bit_length() - 1
+    scoring = [1] * (num_rounds - len(tourney.ROUND_POINTS)) + tourney.ROUND_POINTS
+
+    positions = {"points": 1000}
+    for i in rng.choice(num_teams, size=max(1, num_teams // 4), replace=False):
+        positions[names[i]] = int(rng.integers(-500, 500))
+
+    return bracket, ratings, scoring, positions
+
+
+# (winner, loser) results for the play-ins and the first num_rounds rounds of
+# a synthetic bracket, with the first team of every game winning
+def synthetic_results(bracket, num_rounds):
+    results = []
+    alive = []
+    for game in bracket:
+        teams = list(game)
+        alive.append(teams[0])
+        results += [(teams[0], loser) for loser in teams[1:]]
+    for _ in range(num_rounds):
+        results += list(zip(alive[0::2], alive[1::2]))
+        alive = alive[0::2]
+    return results
+
+
+def make_state(bracket, ratings, scoring, results=None):
+    return tourney.TournamentState(
+        bracket=bracket, ratings=ratings, scoring=scoring, results=results
+    )
+
+
+# Each benchmark takes the synthetic inputs and returns the function to time.
+# Work that the function should not pay for (e.g. filling the state's caches)
+# happens here, outside the timed call.
+def bench_calculate_scores_prob(bracket, ratings, scoring, positions):
+    return lambda: make_state(bracket, ratings, scoring).calculate_scores_prob()
+
+
+def bench_calculate_scores_cached(bracket, ratings, scoring, positions):
+    state = make_state(bracket, ratings, scoring)
+    state.expected_scores()
+    return state.calculate_scores_prob
+
+
+# the state once all but the last four rounds are decided
+def bench_calculate_scores_late(bracket, ratings, scoring, positions):
+    num_rounds = len(bracket).bit_length() - 1
+    results = synthetic_results(bracket, max(0, num_rounds - 4))
+    return lambda: make_state(
+        bracket, ratings, scoring, results
+    ).calculate_scores_prob()
+
+
+def bench_calculate_win_prob(bracket, ratings, scoring, positions):
+    teams = list(ratings.values())
+    pairs = [
+        (teams[i % len(teams)], teams[(7 * i + 1) % len(teams)]) for i in range(1000)
+    ]
+    return lambda: [tourney.calculate_win_prob(team1, team2) for team1, team2 in pairs]
+
+
+def bench_win_prob_matrix(bracket, ratings, scoring, positions):
+    state = make_state(bracket, ratings, scoring)
+    return lambda: tourney.model_win_prob_matrix(state.team_ratings())
+
+
+def bench_deltas_analytic(bracket, ratings, scoring, positions):
+    state = make_state(bracket, ratings, scoring)
+    return lambda: pv.get_all_team_deltas_analytic(positions, state)
+
+
+def bench_deltas_bump(bracket, ratings, scoring, positions):
+    state = make_state(bracket, ratings, scoring)
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            pv.get_all_team_deltas(positions, state)
+
+    return run
+
+
+def bench_game_deltas(bracket, ratings, scoring, positions):
+    state = make_state(bracket, ratings, scoring)
+    return lambda: pv.game_deltas(positions, state)
+
+
+def bench_get_portfolio_value(bracket, ratings, scoring, positions):
+    values = make_state(bracket, ratings, scoring).calculate_scores_prob()
+    return lambda: pv.get_portfolio_value(positions, values, float)
+
+
+def bench_simulate(bracket, ratings, scoring, positions):
+    state = make_state(bracket, ratings, scoring)
+    state.expected_scores()
+    rng = np.random.default_rng(0)
+    return lambda: state.simulate_scores(10000, rng)
+
+
+def bench_score_covariance(bracket, ratings, scoring, positions):
+    state = make_state(bracket, ratings, scoring)
+    state.expected_scores()
+    return state.score_covariance
+
+
+# two-leg baskets of every team, scored against a cached covariance
+def bench_trade_search(bracket, ratings, scoring, positions):
+    state = make_state(bracket, ratings, scoring)
+    optimizer = trade_optimizer.TradeOptimizer(state, positions)
+    return lambda: optimizer.search([10, 100], max_legs=2)
+
+
+# name -> (benchmark, largest field it is run on)
+BENCHMARKS = {
+    "calculate_scores_prob": (bench_calculate_scores_prob, None),
+    "calculate_scores_cached": (bench_calculate_scores_cached, None),
+    "calculate_scores_late": (bench_calculate_scores_late, None),
+    "calculate_win_prob": (bench_calculate_win_prob, None),
+    "win_prob_matrix": (bench_win_prob_matrix, None),
+    "deltas_analytic": (bench_deltas_analytic, None),
+    "deltas_bump": (bench_deltas_bump, None),
+    "game_deltas": (bench_game_deltas, None),
+    "get_portfolio_value": (bench_get_portfolio_value, None),
+    "simulate_10k": (bench_simulate, None),
+    "score_covariance": (bench_score_covariance, None),
+    "trade_search": (bench_trade_search, None),
+}
+
+
+# Calls func until min_time has passed (and at least min_runs times) and
+# returns per-call timings in seconds.
+def time_func(func, min_time=0.5, min_runs=3):
+    func()
+    timings = []
+    start = time.perf_counter()
+    while len(timings) < min_runs or time.perf_counter() - start < min_time:
+        call_start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - call_start)
+    return timings
+
+
+def run_benchmarks(sizes, names, min_time=0.5):
+    results = {}
+    for size in sizes:
+        inputs = synthetic_tournament(size)
+        for name in names:
+            bench, max_size = BENCHMARKS[name]
+            if max_size is not None and size > max_size:
+                continue
+            timings = time_func(bench(*inputs), min_time)
+            key = "{0}/{1}".format(name, size)
+            results[key] = {
+                "median": statistics.median(timings),
+                "min": min(timings),
+                "runs": len(timings),
+            }
+            sys.stderr.write(
+                "{0:32} {1:12.6f}s ({2} runs)\n".format(
+                    key, results[key]["median"], len(timings)
+                )
+            )
+    return results
+
+
+# Compares median timings against a baseline run; returns the benchmarks that
+# got slower than threshold times their baseline
+def compare(results, baseline, threshold):
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline:
+            print("{0:32} {1:12.6f}s (new)".format(key, results[key]["median"]))
+            continue
+        ratio = results[key]["median"] / baseline[key]["median"]
+        flag = ""
+        if ratio > threshold:
+            regressions.append(key)
+            flag = " REGRESSION"
+        print(
+            "{0:32} {1:12.6f}s vs {2:12.6f}s  x{3:.2f}{4}".format(
+                key, results[key]["median"], baseline[key]["median"], ratio, flag
+            )
+        )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs="+", type=int, default=SIZES)
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=None)
+    parser.add_argument("--min_time", action="store", type=float, default=0.5)
+    parser.add_argument("--out", action="store")
+    parser.add_argument("--compare", action="store")
+    parser.add_argument("--threshold", action="store", type=float, default=1.25)
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.only or list(BENCHMARKS), args.min_time)
+    report = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+
+    if args.out:
+        with open(args.out, "w") as out_file:
+            json.dump(report, out_file, indent=1, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=1, sort_keys=True)
+        print()
+
+    if args.compare:
+        with open(args.compare, "r") as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("{0} regressions".format(len(regressions)))
+            sys.exit(1)
@@ -1,52 +1,51 @@
 import argparse
-from decimal import Decimal
+import csv
 from dotenv import load_dotenv
+import numpy as np
 import os
+import sys
 
 import cix_client
 import portfolio_value as pv
+import profiling
 import tourney_utils as tourney
 
 load_dotenv()
 
 
-def bracket_games(bracket, overrides):
-    games = list(bracket)
-    while games:
-        new_games = []
-        for i in range(len(games) / 2):
-            team1, team2 = tuple(games[i * 2 : (i + 1) * 2])
-            prob = overrides.get_override(team1, team2)
-            if prob >= Decimal(1):
-                new_games.append(team1)
-            elif prob == Decimal(0):
-                new_games.append(team2)
-            else:
-                yield team1, team2
-        games = new_games
-
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("bracket_file")
     parser.add_argument("ratings_file")
-    parser.add_argument("team1")
-    parser.add_argument("team2")
+    parser.add_argument("team1", nargs="?")
+    parser.add_argument("team2", nargs="?")
     parser.add_argument("--overrides", action="append")
+    parser.add_argument("--results", action="append")
     parser.add_argument("--adjustments", action="store")
     parser.add_argument("--sort", action="store", default="name")
     parser.add_argument("--calcutta", action="store_true")
     parser.add_argument("--team_deltas", action="store_true")
+    parser.add_argument("--scenarios", action="store_true")
+    parser.add_argument("--slate", action="store")
+    parser.add_argument("--scenario_rows", action="store", type=int, default=10)
+    parser.add_argument(
+        "--backend", action="store", default="float", choices=tourney.BACKENDS
+    )
+    parser.add_argument("--profile", nargs="?", const="-", metavar="PATH")
     args = parser.parse_args()
 
+    if args.profile:
+        profiling.enable(args.profile)
+    number = tourney.BACKENDS[args.backend]
+
     if args.adjustments:
         with open(args.adjustments, "r") as adjustments_file:
-            adjustments = tourney.read_adjustments_file(adjustments_file)
+            adjustments = tourney.read_adjustments_file(adjustments_file, number)
     else:
         adjustments = {}
 
     with open(args.ratings_file, "r") as ratings_file:
-        ratings = tourney.read_ratings_file(ratings_file, adjustments)
+        ratings = tourney.read_ratings_file(ratings_file, adjustments, number)
 
     if args.calcutta:
         scoring = tourney.CALCUTTA_POINTS
@@ -57,26 +56,81 @@ if __name__ == "__main__":
     if args.overrides:
         for override_file in args.overrides:
             overrides.read_from_file(override_file)
-    bracket = tourney.read_games_from_file(args.bracket_file, ratings, overrides)
+    bracket = tourney.read_games_from_file(
+        args.bracket_file, ratings, overrides, number
+    )
 
     client = cix_client.CixClient(os.environ["CIX_APID"])
     positions = client.my_positions(full_names=True)
 
     tournament = tourney.TournamentState(
-        bracket=bracket, ratings=ratings, overrides=overrides, scoring=scoring
+        bracket=bracket,
+        ratings=ratings,
+        overrides=overrides,
+        scoring=scoring,
+        backend=args.backend,
     )
 
-    win_value, loss_value, team_deltas = pv.game_delta(
-        positions, tournament, args.team1, args.team2
-    )
+    if args.results:
+        results = [
+            row for path in args.results for row in tourney.read_results_file(path)
+        ]
+        for winner, loser in tournament.apply_results(results):
+            sys.stderr.write("{0} over {1} is not a game yet\n".format(winner, loser))
 
-    print("If {0} wins: {1:.2f}".format(args.team1, win_value))
-    print("If {0} wins: {1:.2f}".format(args.team2, loss_value))
-    print("Delta: {0:.2f}".format(win_value - loss_value))
+    if args.team1 and args.team2:
+        games = [(args.team1, args.team2)]
+    elif args.slate:
+        with open(args.slate, "r") as slate_file:
+            games = [tuple(row[:2]) for row in csv.reader(slate_file) if row]
+    else:
+        games = None
 
-    if args.team_deltas:
-        for team in sorted(team_deltas, key=(lambda x: -1 * abs(x.total_delta))):
-            if abs(team.delta_per_share) >= 0.001 and team.position != 0:
-                print(
-                    f"\tdelta for team {team.team} = {team.delta_per_share:.3f} * {team.position} = {team.total_delta:.0f}"
+    if args.scenarios:
+        try:
+            report = pv.scenario_report(positions, tournament, games)
+        except ValueError as ex:
+            sys.stderr.write("{0}\n".format(ex))
+            exit(1)
+        print("{0} games, {1} scenarios".format(len(report.games), len(report.values)))
+        print("current value: {0:.2f}".format(report.baseline))
+        print("expected value: {0:.2f}".format(report.expected))
+        print("probability of loss: {0:.3f}".format(report.loss_prob))
+        order = np.argsort(report.values)
+        rows = args.scenario_rows
+        shown = (
+            order
+            if len(order) <= 2 * rows
+            else np.concatenate([order[:rows], order[-rows:]])
+        )
+        for s in shown:
+            if s == report.worst:
+                label = " (worst)"
+            elif s == report.best:
+                label = " (best)"
+            else:
+                label = ""
+            print(
+                "{0:.2f} p={1:.4f}{2}: {3}".format(
+                    report.values[s],
+                    report.probs[s],
+                    label,
+                    ", ".join(pv.scenario_winners(report, s)),
                 )
+            )
+        exit(0)
+
+    for game in pv.game_deltas(positions, tournament, games):
+        win_value, loss_value = game.win_portfolio, game.loss_portfolio
+        print("If {0} wins: {1:.2f}".format(game.team1, win_value))
+        print("If {0} wins: {1:.2f}".format(game.team2, loss_value))
+        print("Delta: {0:.2f}".format(win_value - loss_value))
+
+        if args.team_deltas:
+            for team in sorted(
+                game.team_deltas, key=(lambda x: -1 * abs(x.total_delta))
+            ):
+                if abs(team.delta_per_share) >= 0.001 and team.position != 0:
+                    print(
+                        f"\tdelta for team {team.team} = {team.delta_per_share:.3f} * {team.position} = {team.total_delta:.0f}"
+                    )
@@ -2,6 +2,7 @@
 #!/usr/bin/python
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from decimal import Decimal
 import json
 from math import sqrt
@@ -9,143 +10,56 @@ import os
 import re
 import sys
 import requests
-import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 
+import http_cache
+import profiling
+import team_names
+
 load_dotenv()
 
 RATINGS_URL = "http://kenpom.com/"
 BRACKET_URL = "http://espn.go.com/ncb/bracketology"
-GAMEPREDICT_URL = (
-    "http://gamepredict.us/teams/matchup_table?team_a={0}&team_b={1}&neutral=true"
-)
+GAMEPREDICT_URL = os.getenv("GAMEPREDICT_URL", "http://gamepredict.us")
+GAMEPREDICT_PATH = "/teams/matchup_table"
+PROBS_CHECKPOINT = "probs.txt.partial"
+PROB_WORKERS = 16
+PROB_RETRIES = 4
+PROB_TIMEOUT = 30
+# how long a cached page or odds response is used without revalidating it
+PAGE_MAX_AGE = 15 * 60
+ODDS_MAX_AGE = 60
 ODDS_API_KEY = os.getenv("ODDS_API_KEY")
 ODDS_API_URL = "https://api.the-odds-api.com/v4/sports/basketball_ncaab/odds?apiKey={}&regions=us&oddsFormat=decimal".format(
     ODDS_API_KEY
 )
 CHROME_UA = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/111.0.0.0 Safari/537.36"
 
-NAME_CONVERSIONS = {
-    "Miami": "Miami FL",
-    "Southern Cal": "USC",
-    "St. Mary's (ca)": "Saint Mary's",
-    "Virginia Commonwealth": "VCU",
-    "Miami (fl)": "Miami FL",
-    "Middle Tennessee St.": "Middle Tennessee",
-    "Se Louisiana": "Southeastern Louisiana",
-    "Arkansas-pine Bluff": "Arkansas Pine Bluff",
-    "Louisiana": "Louisiana Lafayette",
-    "Charleston": "College of Charleston",
-    "Nc St.": "North Carolina St.",
-    "Texas A&m;": "Texas A&M;",
-    "Loyola-chicago": "Loyola Chicago",
-    "Cs Fullerton": "Cal St. Fullerton",
-    "Csu Fullerton": "Cal St. Fullerton",
-    "Suny-buffalo": "Buffalo",
-    "Md-baltimore County": "UMBC",
-    "Texas Am": "Texas A&M;",
-    "Pennsylvania": "Penn",
-    "College Of Charleston": "College of Charleston",
-    "Texas Christian": "TCU",
-    "Ole Miss": "Mississippi",
-    "Gardner-webb": "Gardner Webb",
-    "Texas So.": "Texas Southern",
-    "UCSB": "UC Santa Barbara",
-    "E. Washington": "Eastern Washington",
-    "Uconn": "Connecticut",
-    "Uncg": "UNC Greensboro",
-    "Louisiana St.": "LSU",
-    "Texas A&m-cc": "Texas A&M Corpus Chris",
-    "Loyola (chi)": "Loyola Chicago",
-    "Se Missourist.": "Southeast Missouri St.",
-    "Fdu": "Fairleigh Dickinson",
-    "Tamu-cc": "Texas A&M Corpus Chris",
-    "North Carolina St.": "N.C. State",
-    "College of Charleston": "Charleston",
-    "Louisiana Lafayette": "Louisiana",
-    "Fla. Atlantic": "Florida Atlantic",
-    "No. Kentucky": "Northern Kentucky",
-}
-
-WORD_ABBREVS = set(
-    [
-        "Unc",
-        "Ucla",
-        "Smu",
-        "Vcu",
-        "Uc",
-        "Tcu",
-        "Liu",
-        "Usc",
-        "A&m",
-        "A&m;",
-        "Lsu",
-        "Ucf",
-        "Ucsb",
-        "Byu",
-        "Uab",
+def parse_bracket(html):
+    soup = BeautifulSoup(html, "html.parser")
+    bracket = soup.find("div", {"class": "bracket__region"})
+    return [
+        entry.text.split("/")
+        for entry in bracket.find_all("a", {"class": "bracket__link"})
     ]
-)
 
-WORD_CONVERSIONS = {
-    "State": "St.",
-    "St": "St.",
-    "Marys": "Mary's",
-}
-
-
-def clean_name(s):
-    s = s.replace("aq - ", "").replace(" - aq", "")
-    words = s.split()
-    for i in range(len(words)):
-        word = words[i].lower()
-        word = word[0].upper() + word[1:].lower()
-        if word in WORD_ABBREVS:
-            word = word.upper()
-        word = WORD_CONVERSIONS.get(word, word)
-        words[i] = word
-    cleaned = " ".join(words)
-    return NAME_CONVERSIONS.get(cleaned, cleaned)
-
-
-def clean_api_name(s):
-    words = s.split()
-
-    # remove at least one word of team name
-    words = words[:-1]
-
-    if words[-1] in (
-        "Blue",
-        "Tar",
-        "Red",
-        "Fighting",
-        "Scarlet",
-        "Horned",
-        "Golden",
-        "Crimson",
-    ):
-        words = words[:-1]
 
-    return clean_name(" ".join(words))
+def get_bracket(out_file, names, cache):
+    entries = cache.parsed(BRACKET_URL, parse_bracket, max_age=PAGE_MAX_AGE)
+    for entry in entries:
+        entry_names = [names.canonical("espn", name) for name in entry]
+        out_file.write("{0}\n".format(",".join(entry_names)))
 
 
-def get_bracket(out_file):
-    html = requests.get(BRACKET_URL).text
-    soup = BeautifulSoup(html, "html.parser")
-    bracket = soup.find("div", {"class": "bracket__region"})
-    for entry in bracket.find_all("a", {"class": "bracket__link"}):
-        team_names = [clean_name(name) for name in entry.text.split("/")]
-        out_file.write("{0}\n".format(",".join(team_names)))
-
-
-def get_ratings(out_file):
-    headers = {"User-Agent": CHROME_UA}
-    html = requests.get(RATINGS_URL, headers=headers).text
+def parse_ratings(html):
     soup = BeautifulSoup(html, "html.parser")
     ratings = soup.find("table", {"id": "ratings-table"})
     ratings = ratings.tbody
+    rows = []
     for row in ratings.find_all("tr"):
         columns = row.find_all("td")
         data_columns = row.find_all("td", {"class": "td-left"})
@@ -155,33 +69,143 @@ def get_ratings(out_file):
         offense = data_columns[0].string
         defense = data_columns[1].string
         tempo = data_columns[2].string
-        out_file.write("{0}\n".format("|".join((team_name, offense, defense, tempo))))
+        rows.append([team_name, offense, defense, tempo])
+    return rows
 
 
-def get_pairwise_prob(a, b):
-    html = requests.get(
-        GAMEPREDICT_URL.format(urllib3.quote(a), urllib3.quote(b))
-    ).read()
+def get_ratings(out_file, cache):
+    headers = {"User-Agent": CHROME_UA}
+    rows = cache.parsed(RATINGS_URL, parse_ratings, headers, PAGE_MAX_AGE)
+    for row in rows:
+        out_file.write("{0}\n".format("|".join(row)))
+
+
+def make_session(pool_size=PROB_WORKERS, retries=PROB_RETRIES):
+    # one pooled connection per worker; transient failures are retried with
+    # exponential backoff before a pair is given up on
+    retry = Retry(
+        total=retries,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET",),
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def parse_pairwise_prob(html):
     soup = BeautifulSoup(html, "html.parser")
     cols = soup.find_all("div", {"class": "col-xs-6"})
     perc_str = cols[2].find_all("p")[0].string.strip()
     return int(perc_str[:-1]) / 100.0
 
 
-# Start with the lazy approach of scraping all probs from gamepredict
-def get_pairwise_probs(teams, out_file):
-    for i in range(len(teams)):
-        for j in range(i + 1, len(teams)):
+def get_pairwise_prob(session, a, b, base_url=GAMEPREDICT_URL):
+    with profiling.timer("gamepredict_fetch"):
+        response = session.get(
+            base_url + GAMEPREDICT_PATH,
+            params={"team_a": a, "team_b": b, "neutral": "true"},
+            timeout=PROB_TIMEOUT,
+        )
+    response.raise_for_status()
+    return parse_pairwise_prob(response.text)
+
+
+def read_checkpoint(checkpoint_path):
+    probs = {}
+    try:
+        with open(checkpoint_path, "r") as checkpoint_file:
+            for line in checkpoint_file:
+                fields = line.rstrip("\n").split(",")
+                # a line cut off by an interrupted write is simply refetched
+                if len(fields) != 3:
+                    continue
+                try:
+                    probs[(fields[0], fields[1])] = float(fields[2])
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return probs
+
+
+# Fetches every pairwise probability from gamepredict with a pool of workers
+# sharing one session. Each result is appended to the checkpoint file as it
+# arrives so an interrupted run picks up where it stopped; once every pair is
+# in, the probabilities are written to out_file in bracket order and the
+# checkpoint is removed. Returns the pairs that still failed after retries.
+def get_pairwise_probs(
+    teams,
+    out_file,
+    names=None,
+    base_url=GAMEPREDICT_URL,
+    workers=PROB_WORKERS,
+    retries=PROB_RETRIES,
+    checkpoint_path=PROBS_CHECKPOINT,
+):
+    names = names if names is not None else team_names.get_index()
+    pairs = [
+        (teams[i], teams[j])
+        for i in range(len(teams))
+        for j in range(i + 1, len(teams))
+    ]
+
+    probs = read_checkpoint(checkpoint_path)
+    remaining = [pair for pair in pairs if pair not in probs]
+    if probs:
+        sys.stderr.write(
+            "resuming with {0} of {1} pairs already fetched\n".format(
+                len(pairs) - len(remaining), len(pairs)
+            )
+        )
+
+    failed = []
+    session = make_session(workers, retries)
+    with open(checkpoint_path, "a") as checkpoint_file, ThreadPoolExecutor(
+        workers
+    ) as executor:
+        futures = dict(
+            (
+                executor.submit(
+                    get_pairwise_prob,
+                    session,
+                    names.external("gamepredict", a),
+                    names.external("gamepredict", b),
+                    base_url,
+                ),
+                (a, b),
+            )
+            for a, b in remaining
+        )
+        for future in as_completed(futures):
+            a, b = futures[future]
             try:
-                prob = get_pairwise_prob(teams[i], teams[j])
-                out_file.write(
-                    "{0}\n".format(",".join((teams[i], teams[j], str(prob))))
-                )
-            except:
+                prob = future.result()
+            except Exception as e:
                 sys.stderr.write(
-                    "prob failed for teams {0}, {1}\n".format(teams[i], teams[j])
+                    "prob failed for teams {0}, {1}: {2}\n".format(a, b, e)
                 )
-                raise
+                failed.append((a, b))
+                continue
+            probs[(a, b)] = prob
+            checkpoint_file.write("{0}\n".format(",".join((a, b, str(prob)))))
+            checkpoint_file.flush()
+
+    if failed:
+        sys.stderr.write(
+            "{0} pairs failed; rerun to resume from {1}\n".format(
+                len(failed), checkpoint_path
+            )
+        )
+        return failed
+
+    for a, b in pairs:
+        out_file.write("{0}\n".format(",".join((a, b, str(probs[(a, b)])))))
+    os.remove(checkpoint_path)
+    return failed
 
 
 ODDS_REGEX = re.compile("[-+][1-9][0-9]{2,}")
@@ -201,9 +225,11 @@ def convert_american_odds(odds_str):
         assert False
 
 
-def get_odds():
-    raw_odds = json.loads(requests.get(ODDS_API_URL).text)
-    all_odds = {}
+# (away team, home team, away win prob) for every game with prices, using the
+# feed's own team names
+def parse_odds(body):
+    raw_odds = json.loads(body)
+    games = []
 
     for game in raw_odds:
         away_team = game["away_team"]
@@ -233,10 +259,19 @@ def get_odds():
 
         mixed_win_prob = sqrt(float(away_win_prob * (Decimal(1.0) - home_win_prob)))
 
-        all_odds[
-            (clean_api_name(away_team), clean_api_name(home_team))
-        ] = mixed_win_prob
+        games.append([away_team, home_team, mixed_win_prob])
 
+    return games
+
+
+def get_odds(names, cache, max_age=ODDS_MAX_AGE):
+    all_odds = {}
+    for away_team, home_team, win_prob in cache.parsed(
+        ODDS_API_URL, parse_odds, max_age=max_age
+    ):
+        all_odds[
+            (names.canonical("odds", away_team), names.canonical("odds", home_team))
+        ] = win_prob
     return all_odds
 
 
@@ -268,22 +303,46 @@ def get_previous_odds():
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("data_type", choices=["bracket", "ratings", "probs", "odds"])
+    parser.add_argument("--workers", type=int, default=PROB_WORKERS)
+    parser.add_argument("--retries", type=int, default=PROB_RETRIES)
+    parser.add_argument("--base_url", default=GAMEPREDICT_URL)
+    parser.add_argument("--checkpoint", default=PROBS_CHECKPOINT)
+    parser.add_argument("--cache_dir", default=http_cache.CACHE_DIR)
     args = parser.parse_args()
 
+    names = team_names.get_index()
+    cache = http_cache.HttpCache(args.cache_dir)
+    status = 0
+
     if args.data_type == "bracket":
         with open("bracket.txt", "w") as bracket_file:
-            get_bracket(bracket_file)
+            get_bracket(bracket_file, names, cache)
     elif args.data_type == "ratings":
         with open("ratings.txt", "w") as ratings_file:
-            get_ratings(ratings_file)
+            get_ratings(ratings_file, cache)
     elif args.data_type == "probs":
         with open("bracket.txt", "r") as bracket_file:
             all_teams = read_team_names(bracket_file)
-        with open("probs.txt", "w") as probs_file:
-            get_pairwise_probs(all_teams, probs_file)
+        # written to a temporary file so a failed run leaves the old probs.txt
+        # in place
+        with open("probs.txt.tmp", "w") as probs_file:
+            failed = get_pairwise_probs(
+                all_teams,
+                probs_file,
+                names,
+                base_url=args.base_url,
+                workers=args.workers,
+                retries=args.retries,
+                checkpoint_path=args.checkpoint,
+            )
+        if failed:
+            os.remove("probs.txt.tmp")
+            status = 1
+        else:
+            os.replace("probs.txt.tmp", "probs.txt")
     elif args.data_type == "odds":
         old_odds = get_previous_odds()
-        new_odds = get_odds()
+        new_odds = get_odds(names, cache)
 
         with open("odds.txt", "w") as overrides_file:
             for teams, win_prob in new_odds.items():
@@ -302,3 +361,8 @@ if __name__ == "__main__":
                     )
     else:
         print("unrecognized data type {}".format(args.data_type))
+
+    if names.changed:
+        names.save()
+    cache.prune()
+    sys.exit(status)
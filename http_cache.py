@@ -0,0 +1,139 @@
+from collections import namedtuple
+import hashlib
+import json
+import os
+import time
+
+import requests
+
+import profiling
+
+CACHE_DIR = os.getenv("HTTP_CACHE_DIR", ".http_cache")
+
+# body is the raw response bytes, digest their sha256, and changed is False
+# when the body is the same one this url returned last time
+CachedResponse = namedtuple("CachedResponse", ["body", "digest", "changed"])
+
+
+def _write_atomic(path, data):
+    tmp_path = "{0}.tmp".format(path)
+    with open(tmp_path, "wb") as out_file:
+        out_file.write(data)
+    os.replace(tmp_path, path)
+
+
+# On-disk cache of GET responses. Bodies are stored once under their sha256
+# in bodies/, and index.json records for each url (keyed by its hash, so api
+# keys in query strings never land on disk) the digest of the last body along
+# with its ETag/Last-Modified validators and when it was last confirmed.
+#
+# A response younger than max_age is served without touching the network;
+# an older one is revalidated with a conditional request, and a 304 reuses
+# the stored body. Parsed results are stored by body digest too, so a page
+# that comes back byte-identical is never parsed twice.
+class HttpCache:
+    def __init__(self, path=CACHE_DIR, session=None):
+        self.path = path
+        self.session = session if session is not None else requests.Session()
+        self.bodies_path = os.path.join(path, "bodies")
+        self.parsed_path = os.path.join(path, "parsed")
+        self.index_path = os.path.join(path, "index.json")
+        os.makedirs(self.bodies_path, exist_ok=True)
+        os.makedirs(self.parsed_path, exist_ok=True)
+
+        try:
+            with open(self.index_path, "r") as index_file:
+                self.index = json.load(index_file)
+        except (FileNotFoundError, ValueError):
+            self.index = {}
+
+    @staticmethod
+    def url_key(url):
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def _body_file(self, digest):
+        return os.path.join(self.bodies_path, digest)
+
+    def _read_body(self, digest):
+        try:
+            with open(self._body_file(digest), "rb") as body_file:
+                return body_file.read()
+        except FileNotFoundError:
+            return None
+
+    def _save_index(self):
+        _write_atomic(
+            self.index_path, json.dumps(self.index, indent=1, sort_keys=True).encode()
+        )
+
+    def fetch(self, url, headers=None, max_age=0):
+        key = self.url_key(url)
+        entry = self.index.get(key)
+        body = self._read_body(entry["digest"]) if entry else None
+        # an entry whose body went missing is fetched from scratch
+        if body is None:
+            entry = None
+
+        now = time.time()
+        if entry and now - entry["checked"] < max_age:
+            profiling.count("fetch_fresh")
+            return CachedResponse(body, entry["digest"], False)
+
+        request_headers = dict(headers or {})
+        if entry:
+            if entry.get("etag"):
+                request_headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                request_headers["If-Modified-Since"] = entry["last_modified"]
+
+        with profiling.timer("fetch"):
+            response = self.session.get(url, headers=request_headers, timeout=30)
+        if entry and response.status_code == 304:
+            profiling.count("fetch_not_modified")
+            entry["checked"] = now
+            self._save_index()
+            return CachedResponse(body, entry["digest"], False)
+        response.raise_for_status()
+
+        body = response.content
+        digest = hashlib.sha256(body).hexdigest()
+        if not os.path.exists(self._body_file(digest)):
+            _write_atomic(self._body_file(digest), body)
+
+        changed = entry is None or entry["digest"] != digest
+        self.index[key] = {
+            "digest": digest,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "checked": now,
+        }
+        self._save_index()
+        return CachedResponse(body, digest, changed)
+
+    # parse(body) must return something json serializable; its result is
+    # kept per body digest and parser name, so bump the name (or clear the
+    # cache) when a parser's output format changes
+    def parsed(self, url, parse, headers=None, max_age=0):
+        response = self.fetch(url, headers, max_age)
+        parsed_file = os.path.join(
+            self.parsed_path, "{0}.{1}.json".format(response.digest, parse.__name__)
+        )
+        try:
+            with open(parsed_file, "r") as in_file:
+                return json.load(in_file)
+        except (FileNotFoundError, ValueError):
+            pass
+
+        result = parse(response.body)
+        _write_atomic(parsed_file, json.dumps(result).encode())
+        return result
+
+    # drops bodies and parsed results that no url points at any more
+    def prune(self):
+        live = set(entry["digest"] for entry in self.index.values())
+        for name in os.listdir(self.bodies_path):
+            if name not in live:
+                os.remove(os.path.join(self.bodies_path, name))
+        for name in os.listdir(self.parsed_path):
+            if name.split(".", 1)[0] not in live:
+                os.remove(os.path.join(self.parsed_path, name))
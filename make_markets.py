@@ -2,20 +2,23 @@ import argparse
 from decimal import Decimal, ROUND_UP, ROUND_DOWN
 from dotenv import load_dotenv
 import os
-import re
+import sys
+import time
 
 import cix_client
+import order_pipeline as orders
 import portfolio_value as pv
+import profiling
 import tourney_utils as tourney
+import trade_optimizer
 
 load_dotenv()
 
-APID = os.environ["CIX_APID"]
+APID = os.getenv("CIX_APID")
 
-# determine portfolio delta for each team
-# determine pairwise deltas (foreach pair of teams, how does X's performance impact Y?)
-
-# use this to determine how much risk any additional trade would expose (across all teams in portfolio)
+# portfolio deltas say how a rating change moves each position; the risk any
+# additional trade would expose, across all teams held, comes from the
+# trade optimizer's score covariance (--optimize)
 
 
 def get_positions():
@@ -23,8 +26,9 @@ def get_positions():
     return client.my_positions()
 
 
+# values may come from either backend; quotes are always Decimal
 def get_spread(team, values, portfolio, base_margin=Decimal("0.05")):
-    team_ev = values[team]
+    team_ev = Decimal(values[team])
     base_bid = team_ev * (1 - base_margin)
     base_ask = team_ev * (1 + base_margin)
 
@@ -34,22 +38,190 @@ def get_spread(team, values, portfolio, base_margin=Decimal("0.05")):
     return bid, ask
 
 
-def canonicalize_name(name):
-    name_overrides = {
-        "Miami FL": "Miami (FL)",
-        "Texas A&M Corpus Chris": "Texas A&M Corpus Christi",
-        "Cal St. Fullerton": "CSU Fullerton",
-    }
+# a quote is resent once its bid or ask has moved by at least tick
+def quote_moved(sent, quote, tick):
+    if sent is None:
+        return True
+    return abs(quote[0] - sent[0]) >= tick or abs(quote[1] - sent[1]) >= tick
+
+
+# submits quotes through the order pipeline, prints its report and returns
+# it
+def send_quotes(client, quotes, args):
+    start = time.monotonic()
+    results = orders.submit_quotes(
+        client, quotes, args.order_workers, args.order_rate, args.order_retries
+    )
+    report = orders.summarize(results, time.monotonic() - start)
+    orders.print_report(report)
+    return report
+
+
+def file_mtimes(paths):
+    return dict((path, os.stat(path).st_mtime_ns) for path in paths)
+
 
-    try:
-        return name_overrides[name]
-    except KeyError:
-        pass
+# Re-reads the ratings file into the state's existing Ratings, replacing only
+# the teams whose ratings changed, and recomputes the play-ins from them.
+def reload_ratings(state, ratings_path, adjustments, number):
+    with open(ratings_path, "r") as ratings_file:
+        new_ratings = tourney.read_ratings_file(ratings_file, adjustments, number)
+    for name, team in new_ratings.items():
+        old = state.ratings.get(name)
+        if old is None or (old.offense, old.defense, old.tempo) != (
+            team.offense,
+            team.defense,
+            team.tempo,
+        ):
+            state.ratings[name] = team
+    state.update_play_ins()
 
-    name = re.sub("St\.$", "State", name)
-    name = re.sub("^Saint", "St.", name)
 
-    return name
+# Re-reads the override files and applies only the overrides that were added,
+# changed or dropped, so the state recomputes just the affected slots.
+def reload_overrides(state, override_paths):
+    new_overrides = tourney.OverridesMap()
+    for path in override_paths:
+        new_overrides.read_from_file(path)
+    old = dict(((name1, name2), prob) for name1, name2, prob in state.overrides.items())
+    new = dict(((name1, name2), prob) for name1, name2, prob in new_overrides.items())
+    rows = [
+        (name1, name2, prob)
+        for (name1, name2), prob in new.items()
+        if old.get((name1, name2)) != prob
+    ]
+    rows += [(name1, name2, None) for name1, name2 in old if (name1, name2) not in new]
+    if rows:
+        state.update_overrides(rows)
+    return len(rows)
+
+
+# expected portfolio value and its exact standard deviation
+def print_portfolio_risk(state, positions):
+    compiled = pv.compile_positions(positions, state)
+    print(
+        "portfolio value: {0:.2f} (sd {1:.2f})".format(
+            state.expected_scores() @ compiled.vector + compiled.cash,
+            pv.get_portfolio_std(compiled, state),
+        )
+    )
+
+
+# Ranks baskets of fills on our own quotes (buying at the bid, selling at the
+# ask) by the mean-variance utility they add to the portfolio.
+def optimize_trades(state, positions, values, portfolio, teams, args):
+    margin = Decimal(args.spread_margin)
+    buy_prices = {}
+    sell_prices = {}
+    for team in teams:
+        if not values[team]:
+            continue
+        buy_prices[team], sell_prices[team] = get_spread(
+            team, values, portfolio, base_margin=margin
+        )
+
+    optimizer = trade_optimizer.TradeOptimizer(
+        state,
+        positions,
+        buy_prices,
+        sell_prices,
+        num_sims=args.covariance_sims,
+        max_position=args.max_position,
+        min_cash=args.min_cash,
+        risk_aversion=args.risk_aversion,
+    )
+    baskets = optimizer.search(
+        args.basket_sizes or [args.order_size],
+        teams=list(buy_prices),
+        max_legs=args.max_legs,
+        count=args.baskets,
+    )
+    trade_optimizer.print_baskets(optimizer.current(), baskets)
+
+
+# Reads the results files into the state, which collapses the decided games
+# out of its bracket. Results only ever accumulate, so rereading a file that
+# grew just adds its new games.
+def reload_results(state, results_paths):
+    results = [row for path in results_paths for row in tourney.read_results_file(path)]
+    for winner, loser in state.apply_results(results):
+        sys.stderr.write("{0} over {1} is not a game yet\n".format(winner, loser))
+
+
+# Keeps the tournament state warm and requotes every interval seconds. Input
+# files are only reloaded when their modification times change, values are
+# only recomputed after a reload, and a team is only requoted once its bid or
+# ask has moved by at least tick since the quote last sent for it. Quotes
+# that fail on transient errors are sent again on the next tick.
+def requote_loop(client, state, portfolio, teams, args, adjustments, number):
+    margin = Decimal(args.spread_margin)
+    tick = Decimal(args.tick)
+    override_paths = args.overrides or []
+    results_paths = args.results or []
+    mtimes = file_mtimes([args.ratings_file] + override_paths + results_paths)
+    sent = {}
+    # quotes that failed on transient errors, sent again on the next tick
+    retry = []
+    values = None
+
+    while True:
+        new_mtimes = file_mtimes([args.ratings_file] + override_paths + results_paths)
+        if new_mtimes[args.ratings_file] != mtimes[args.ratings_file]:
+            reload_ratings(state, args.ratings_file, adjustments, number)
+            values = None
+        if any(new_mtimes[path] != mtimes[path] for path in override_paths):
+            if reload_overrides(state, override_paths):
+                values = None
+        if any(new_mtimes[path] != mtimes[path] for path in results_paths):
+            reload_results(state, results_paths)
+            values = None
+        mtimes = new_mtimes
+
+        quotes = None
+        if values is None:
+            profiling.count("requotes")
+            start = time.perf_counter()
+            values = state.calculate_scores_prob()
+            quotes = []
+            for team in teams:
+                # a team that is worth nothing or eliminated is not quoted,
+                # and a quote already out for it is zeroed
+                if not values[team] or team in state.eliminated:
+                    if sent.get(team, (0, 0)) != (0, 0):
+                        print("{team} market pulled".format(team=team))
+                        quotes.append(orders.Quote(team, Decimal(0), Decimal(0), 0))
+                    continue
+                bid, ask = get_spread(team, values, portfolio, base_margin=margin)
+                if not quote_moved(sent.get(team), (bid, ask), tick):
+                    continue
+                print(
+                    "{team} market: {bid} - {ask}".format(team=team, bid=bid, ask=ask)
+                )
+                quotes.append(orders.Quote(team, bid, ask, args.order_size))
+        elif retry:
+            start = time.perf_counter()
+            quotes = retry
+            print("resubmitting {0} quotes".format(len(quotes)))
+
+        if quotes is not None:
+            if args.dry_run:
+                accepted, retry = quotes, []
+            else:
+                report = send_quotes(client, quotes, args)
+                failed = set(result.quote for result in report.failed)
+                accepted = [quote for quote in quotes if quote not in failed]
+                retry = report.resubmit
+            for quote in accepted:
+                sent[quote.team] = (quote.bid, quote.ask)
+            print(
+                "requoted {0} of {1} teams in {2:.1f} ms".format(
+                    len(accepted), len(teams), 1000 * (time.perf_counter() - start)
+                )
+            )
+            print_portfolio_risk(state, portfolio.positions)
+            sys.stdout.flush()
+
+        time.sleep(args.interval)
 
 
 if __name__ == "__main__":
@@ -58,17 +230,56 @@ if __name__ == "__main__":
     parser.add_argument("ratings_file")
     parser.add_argument("teams", nargs="*", default=None)
     parser.add_argument("--overrides", action="append")
+    parser.add_argument("--results", action="append")
     parser.add_argument("--adjustments", action="store")
     parser.add_argument("--point_delta", action="store", type=float, default=1.0)
-    parser.add_argument("--save_deltas", action="store")
-    parser.add_argument("--load_deltas", action="store")
+    parser.add_argument("--delta_cache", action="store", default=pv.DELTA_CACHE_DIR)
+    parser.add_argument("--no_delta_cache", action="store_true")
     parser.add_argument("--print_deltas", action="store_true")
+    parser.add_argument("--bump_deltas", action="store_true")
+    parser.add_argument("--workers", action="store", type=int)
     parser.add_argument("--spread_margin", action="store", type=float, default=0.05)
     parser.add_argument("--order_size", action="store", type=int, default=5000)
     parser.add_argument("--forfeit_prob", action="store", type=float, default=0.0)
     parser.add_argument("-d", "--dry_run", action="store_true")
     parser.add_argument("--no_prompt", action="store_true")
+    parser.add_argument("--daemon", action="store_true")
+    parser.add_argument("--interval", action="store", type=float, default=5.0)
+    parser.add_argument("--tick", action="store", default="0.02")
+    parser.add_argument(
+        "--order_workers", action="store", type=int, default=orders.ORDER_WORKERS
+    )
+    parser.add_argument(
+        "--order_rate", action="store", type=float, default=orders.ORDER_RATE
+    )
+    parser.add_argument(
+        "--order_retries", action="store", type=int, default=orders.ORDER_RETRIES
+    )
+    parser.add_argument("--fake_client", action="store_true")
+    parser.add_argument("--optimize", action="store_true")
+    parser.add_argument("--baskets", action="store", type=int, default=10)
+    parser.add_argument("--basket_sizes", nargs="+", type=int)
+    parser.add_argument(
+        "--max_legs", action="store", type=int, default=trade_optimizer.MAX_LEGS
+    )
+    parser.add_argument("--max_position", action="store", type=int)
+    parser.add_argument("--min_cash", action="store", type=float, default=0.0)
+    parser.add_argument("--covariance_sims", action="store", type=int)
+    parser.add_argument(
+        "--risk_aversion",
+        action="store",
+        type=float,
+        default=trade_optimizer.RISK_AVERSION,
+    )
+    parser.add_argument(
+        "--backend", action="store", default="float", choices=tourney.BACKENDS
+    )
+    parser.add_argument("--profile", nargs="?", const="-", metavar="PATH")
     args = parser.parse_args()
+    number = tourney.BACKENDS[args.backend]
+
+    if args.profile:
+        profiling.enable(args.profile)
 
     if args.forfeit_prob < 0.0 or args.forfeit_prob >= 1.0:
         sys.stderr.write("invalid forfeit probability\n")
@@ -76,20 +287,25 @@ if __name__ == "__main__":
 
     if args.adjustments:
         with open(args.adjustments, "r") as adjustments_file:
-            adjustments = tourney.read_adjustments_file(adjustments_file)
+            adjustments = tourney.read_adjustments_file(adjustments_file, number)
     else:
         adjustments = {}
 
     with open(args.ratings_file, "r") as ratings_file:
-        ratings = tourney.read_ratings_file(ratings_file, adjustments)
+        ratings = tourney.read_ratings_file(ratings_file, adjustments, number)
 
     overrides = tourney.OverridesMap()
     if args.overrides:
         for override_file in args.overrides:
             overrides.read_from_file(override_file)
-    bracket = tourney.read_games_from_file(args.bracket_file, ratings, overrides)
+    bracket = tourney.read_games_from_file(
+        args.bracket_file, ratings, overrides, number
+    )
 
-    client = cix_client.CixClient(APID)
+    if args.fake_client:
+        client = orders.FakeCixClient()
+    else:
+        client = cix_client.CixClient(APID)
 
     positions = client.my_positions(full_names=True)
     point_delta = Decimal(args.point_delta)
@@ -100,29 +316,56 @@ if __name__ == "__main__":
         overrides=overrides,
         scoring=tourney.ROUND_POINTS,
         forfeit_prob=args.forfeit_prob,
+        backend=args.backend,
     )
+    if args.results:
+        reload_results(tourney_state, args.results)
 
     values = tourney_state.calculate_scores_prob()
 
     portfolio = pv.PortfolioState(
-        tourney_state, positions, point_delta=Decimal(args.point_delta)
+        tourney_state,
+        positions,
+        point_delta=Decimal(args.point_delta),
+        analytic=not args.bump_deltas,
+        workers=args.workers,
+        cache_dir=None if args.no_delta_cache else args.delta_cache,
     )
-
-    if args.load_deltas:
-        portfolio.load_deltas(args.load_deltas)
-    else:
-        portfolio.compute_deltas(args.teams)
-
-    if args.save_deltas:
-        portfolio.store_deltas(args.save_deltas)
+    portfolio.compute_deltas(args.teams)
 
     if args.teams:
         market_teams = args.teams
     else:
         market_teams = tourney.get_bracket_teams(bracket)
+    # eliminated teams keep their banked points but are no longer traded
+    market_teams = [
+        team for team in market_teams if team not in tourney_state.eliminated
+    ]
+
+    if args.optimize:
+        optimize_trades(
+            tourney_state, positions, values, portfolio, list(market_teams), args
+        )
+        sys.exit(0)
 
+    if args.daemon:
+        try:
+            requote_loop(
+                client,
+                tourney_state,
+                portfolio,
+                list(market_teams),
+                args,
+                adjustments,
+                number,
+            )
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    quotes = []
     for team in market_teams:
-        if values[team] == Decimal("0.0"):
+        if not values[team]:
             continue
         if args.print_deltas:
             print(
@@ -138,7 +381,7 @@ if __name__ == "__main__":
                 team=team,
                 bid=bid,
                 ask=ask,
-                value=values[team].quantize(Decimal("0.001")),
+                value=Decimal(values[team]).quantize(Decimal("0.001")),
             )
         )
         if not args.dry_run:
@@ -149,14 +392,8 @@ if __name__ == "__main__":
                 answer = input()
                 do_order = answer[0].lower() == "y"
             if do_order:
-                try:
-                    order_name = canonicalize_name(team)
-                    client.make_market(
-                        order_name,
-                        bid=bid,
-                        bid_size=args.order_size,
-                        ask=ask,
-                        ask_size=args.order_size,
-                    )
-                except cix_client.ApiException as ex:
-                    print("failed to make market: {}".format(", ".join(ex.errors)))
+                quotes.append(orders.Quote(team, bid, ask, args.order_size))
+
+    if quotes:
+        send_quotes(client, quotes, args)
+    print_portfolio_risk(tourney_state, positions)
@@ -0,0 +1,212 @@
+#!python
+
+import argparse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+import random
+import threading
+import time
+
+import cix_client
+import profiling
+import team_names
+
+ORDER_WORKERS = 8
+# requests per second allowed against the exchange
+ORDER_RATE = 20.0
+ORDER_RETRIES = 2
+RETRY_BACKOFF = 0.25
+
+Quote = namedtuple("Quote", ["team", "bid", "ask", "size"])
+
+# one per submitted quote: ok is False once every attempt failed, with error
+# holding the last failure and rejected True if the exchange refused the
+# order (rather than the request failing); latency is the last attempt's
+# round trip to the exchange, leaving out rate limiter waits and retry backoff
+OrderResult = namedtuple(
+    "OrderResult",
+    ["quote", "order_name", "ok", "attempts", "error", "rejected", "latency"],
+)
+
+# resubmit holds the failed quotes that were not rejected, which the caller
+# should send again later
+OrderReport = namedtuple(
+    "OrderReport", ["sent", "failed", "retried", "elapsed", "max_latency", "resubmit"]
+)
+
+
+# Token bucket shared by the submitting threads: at most rate requests per
+# second on average, with bursts of up to burst requests.
+class RateLimiter:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# The exchange rejecting an order (cix_client.ApiException) is final; anything
+# else (timeouts, dropped connections) is retried with exponential backoff.
+def submit_quote(client, quote, limiter, retries=ORDER_RETRIES, names=None):
+    names = names if names is not None else team_names.get_index()
+    order_name = names.external("cix_orders", quote.team)
+    error = None
+    rejected = False
+    for attempt in range(1, retries + 2):
+        limiter.acquire()
+        start = time.monotonic()
+        try:
+            client.make_market(
+                order_name,
+                bid=quote.bid,
+                bid_size=quote.size,
+                ask=quote.ask,
+                ask_size=quote.size,
+            )
+            latency = time.monotonic() - start
+            profiling.record("make_market", latency)
+            return OrderResult(quote, order_name, True, attempt, None, False, latency)
+        except cix_client.ApiException as ex:
+            error = ", ".join(ex.errors)
+            rejected = True
+            break
+        except Exception as ex:
+            error = str(ex) or type(ex).__name__
+            if attempt <= retries:
+                profiling.count("make_market_retries")
+                time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+    return OrderResult(
+        quote, order_name, False, attempt, error, rejected, time.monotonic() - start
+    )
+
+
+# Submits quotes concurrently through one shared client, so its connections
+# are reused, and returns an OrderResult per quote in the order given.
+def submit_quotes(
+    client,
+    quotes,
+    workers=ORDER_WORKERS,
+    rate=ORDER_RATE,
+    retries=ORDER_RETRIES,
+):
+    names = team_names.get_index()
+    limiter = RateLimiter(rate, burst=workers)
+    with ThreadPoolExecutor(workers) as executor:
+        return list(
+            executor.map(
+                lambda quote: submit_quote(client, quote, limiter, retries, names),
+                quotes,
+            )
+        )
+
+
+def summarize(results, elapsed):
+    return OrderReport(
+        sent=sum(1 for result in results if result.ok),
+        failed=[result for result in results if not result.ok],
+        retried=sum(1 for result in results if result.attempts > 1),
+        elapsed=elapsed,
+        max_latency=max([result.latency for result in results] or [0.0]),
+        resubmit=resubmittable(results),
+    )
+
+
+# quotes whose every attempt failed without the exchange rejecting them, so
+# that sending them again later may succeed
+def resubmittable(results):
+    return [result.quote for result in results if not (result.ok or result.rejected)]
+
+
+def print_report(report):
+    for result in report.failed:
+        print(
+            "failed to make market for {0} after {1} attempts: {2}".format(
+                result.quote.team, result.attempts, result.error
+            )
+        )
+    print(
+        "{0} markets sent, {1} failed ({2} to resubmit), {3} retried in "
+        "{4:.2f}s (slowest {5:.0f} ms)".format(
+            report.sent,
+            len(report.failed),
+            len(report.resubmit),
+            report.retried,
+            report.elapsed,
+            1000 * report.max_latency,
+        )
+    )
+
+
+class FakeApiException(cix_client.ApiException):
+    def __init__(self, errors):
+        Exception.__init__(self, errors)
+        self.errors = errors
+
+
+# Stand-in for cix_client.CixClient that never leaves the process: each
+# make_market call sleeps for latency seconds, fails with a transient error
+# with probability failure_rate and is rejected for teams in reject. Used to
+# exercise the pipeline offline.
+class FakeCixClient:
+    def __init__(self, latency=0.05, failure_rate=0.0, reject=(), seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.reject = set(reject)
+        self.random = random.Random(seed)
+        self.markets = {}
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def my_positions(self, full_names=False):
+        return {}
+
+    def make_market(self, name, bid, bid_size, ask, ask_size):
+        time.sleep(self.latency)
+        with self.lock:
+            self.calls += 1
+            if name in self.reject:
+                raise FakeApiException(["market rejected for " + name])
+            if self.random.random() < self.failure_rate:
+                raise ConnectionError("connection reset")
+            self.markets[name] = (bid, bid_size, ask, ask_size)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("bracket_file")
+    parser.add_argument("--workers", action="store", type=int, default=ORDER_WORKERS)
+    parser.add_argument("--rate", action="store", type=float, default=ORDER_RATE)
+    parser.add_argument("--retries", action="store", type=int, default=ORDER_RETRIES)
+    parser.add_argument("--latency", action="store", type=float, default=0.05)
+    parser.add_argument("--failure_rate", action="store", type=float, default=0.0)
+    args = parser.parse_args()
+
+    with open(args.bracket_file, "r") as bracket_file:
+        teams = [
+            team
+            for line in bracket_file
+            if line.strip()
+            for team in line.strip().split(",")
+        ]
+
+    client = FakeCixClient(args.latency, args.failure_rate)
+    quotes = [Quote(team, Decimal("1.00"), Decimal("1.10"), 100) for team in teams]
+    start = time.monotonic()
+    results = submit_quotes(client, quotes, args.workers, args.rate, args.retries)
+    print_report(summarize(results, time.monotonic() - start))
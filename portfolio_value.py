@@ -1,44 +1,127 @@
 from collections import namedtuple
-import pickle
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 from decimal import Decimal
+import hashlib
 import json
+import numpy as np
+import os
 import sys
 
+import profiling
+import team_names
 import tourney_utils as tourney
 
-# why do i do this to myself
-CIX_NAME_CONVERSIONS = {
-    "Michigan State" : "Michigan St.",
-    "Southern California" : "USC",
-    "Middle Tennessee State" : "Middle Tennessee",
-    "Miami" : "Miami FL",
-    "Iowa State" : "Iowa St.",
-    "Kent State" : "Kent St.",
-    "Nevada Reno" : "Nevada",
-    "Virginia Commonwealth" : "VCU",
-    "California Davis" : "UC Davis",
-    "Wichita State" : "Wichita St.",
-    "Florida State" : "Florida St.",
-    "Alabma": "Alabama",
-    "Abilene Chrsitian": "Abilene Christian",
-    "Ohio University": "Ohio",
-    "Brigham Young": "BYU",
-    "Oregon State": "Oregon St.",
-    "Oklahoma State": "Oklahoma St.",
-}
-
-REVERSE_NAME_CONVERSIONS = dict((v, k) for k, v in CIX_NAME_CONVERSIONS.items())
+DELTA_CACHE_DIR = '.delta_cache'
+# delta matrices kept in a cache directory, the least recently used going
+# first once there are more
+DELTA_CACHE_SIZE = 32
 
+# Holds the portfolio and pairwise deltas for a tournament. With a cache_dir,
+# the pairwise deltas are kept on disk as a team-indexed matrix under a hash
+# of everything they depend on, and compute_deltas only computes the teams
+# that are not already there. Every store prunes the directory down to
+# DELTA_CACHE_SIZE matrices.
 class PortfolioState:
-    def __init__(self, tournament, positions, point_delta=Decimal(1)):
+    def __init__(self, tournament, positions, point_delta=Decimal(1),
+            analytic=True, workers=None, cache_dir=None):
         self.tournament = tournament
         self.positions = positions
         self.team_deltas = {}
         self.pairwise_deltas = {}
         self.point_delta = point_delta
-
+        self.analytic = analytic
+        self.workers = workers
+        self.cache_dir = cache_dir
+
+    # Hash of the bracket, ratings, win probabilities (which carry the
+    # overrides, forfeit probability and model constants), point_delta and
+    # delta method. Positions are left out: they only weight the pairwise
+    # deltas into the portfolio deltas.
+    def delta_fingerprint(self):
+        tournament = self.tournament
+        engine = tournament.engine
+        digest = hashlib.sha1(json.dumps([engine.teams, str(self.point_delta),
+            self.analytic, tournament.backend,
+            tournament.forfeit_prob]).encode())
+        for array in (engine.leaves, engine.initial, engine.scoring,
+                tournament.team_ratings(), tournament.win_prob_matrix()):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.hexdigest()
+
+    def _delta_path(self, directory):
+        return os.path.join(directory,
+                '{0}.npy'.format(self.delta_fingerprint()))
+
+    # deltas[i, k] is the change in team i's value for a point_delta bump to
+    # team k, NaN where team k has not been computed
+    def delta_matrix(self):
+        teams = self.tournament.engine.teams
+        deltas = np.full((len(teams), len(teams)), np.nan)
+        for k, team in enumerate(teams):
+            column = self.pairwise_deltas.get(team)
+            if column is not None:
+                deltas[:, k] = [float(column[other]) for other in teams]
+        return deltas
+
+    def set_delta_matrix(self, deltas):
+        tournament = self.tournament
+        teams = tournament.engine.teams
+        number = tournament.number
+        portfolio = compile_positions(self.positions, tournament).vector @ \
+                np.nan_to_num(deltas)
+        for k, team in enumerate(teams):
+            if np.isnan(deltas[0, k]):
+                continue
+            self.team_deltas[team] = number(float(portfolio[k]))
+            self.pairwise_deltas[team] = dict((other, number(float(delta)))
+                    for other, delta in zip(teams, deltas[:, k]))
+
+    # teams eliminated by results are left out: they are no longer in the
+    # engine and their value is fixed
     def compute_deltas(self, teams=None):
         if teams:
+            index = self.tournament.engine.index
+            teams = [team for team in teams if team in index]
+            if not teams:
+                return
+        if self.cache_dir:
+            self.load_deltas(self.cache_dir)
+            wanted = teams or self.tournament.engine.teams
+            missing = [team for team in wanted
+                    if team not in self.pairwise_deltas]
+            if not missing:
+                profiling.count('delta_cache_hits')
+                return
+            if len(missing) < len(wanted):
+                teams = missing
+
+        with profiling.timer('delta_sweep'):
+            self._compute_deltas(teams)
+
+        if self.cache_dir:
+            self.store_deltas(self.cache_dir)
+
+    def _compute_deltas(self, teams=None):
+        if self.analytic:
+            team_deltas, pairwise_deltas = get_all_team_deltas_analytic(
+                    self.positions, self.tournament,
+                    point_delta=self.point_delta)
+            if teams:
+                for team in teams:
+                    self.team_deltas[team] = team_deltas[team]
+                    self.pairwise_deltas[team] = pairwise_deltas[team]
+            else:
+                self.team_deltas, self.pairwise_deltas = team_deltas, \
+                        pairwise_deltas
+        elif self.workers:
+            team_deltas, pairwise_deltas = get_all_team_deltas_parallel(
+                    self.positions, self.tournament,
+                    point_delta=self.point_delta, workers=self.workers,
+                    teams=teams)
+            self.team_deltas.update(team_deltas)
+            self.pairwise_deltas.update(pairwise_deltas)
+        elif teams:
             for team in teams:
                 self.team_deltas[team] = get_team_portfolio_delta(self.positions,
                         self.tournament, team, point_delta=self.point_delta)
@@ -50,14 +133,46 @@ class PortfolioState:
                     self.positions, self.tournament,
                     point_delta=self.point_delta)
 
-
-    def store_deltas(self, path):
-        with open(path, 'wb') as outfile:
-            pickle.dump((self.team_deltas, self.pairwise_deltas), outfile)
-
-    def load_deltas(self, path):
-        with open(path, 'rb') as infile:
-            self.team_deltas, self.pairwise_deltas = pickle.load(infile)
+    def store_deltas(self, directory=DELTA_CACHE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        path = self._delta_path(directory)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as outfile:
+            np.save(outfile, self.delta_matrix())
+        os.replace(tmp_path, path)
+        prune_delta_cache(directory)
+
+    # Loads the deltas stored for the current inputs, memory-mapped rather
+    # than read in. Returns False (leaving the state alone) if there are none.
+    def load_deltas(self, directory=DELTA_CACHE_DIR):
+        path = self._delta_path(directory)
+        try:
+            deltas = np.load(path, mmap_mode='r')
+            # marks the matrix as used for prune_delta_cache
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        self.set_delta_matrix(deltas)
+        return True
+
+# Removes all but the keep most recently used delta matrices in directory.
+# Other processes may be pruning the same directory, so files that are
+# already gone are skipped.
+def prune_delta_cache(directory=DELTA_CACHE_DIR, keep=DELTA_CACHE_SIZE):
+    used = []
+    for name in os.listdir(directory):
+        if name.endswith('.npy'):
+            path = os.path.join(directory, name)
+            try:
+                used.append((os.path.getmtime(path), path))
+            except FileNotFoundError:
+                pass
+    used.sort(reverse=True)
+    for _, path in used[keep:]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
 
 
 def read_values(values_file):
@@ -67,82 +182,193 @@ def read_values(values_file):
         values[team] = Decimal(value)
     return values
 
-def get_portfolio_value(positions, values):
-    total_value = Decimal(0)
+# number should match the type of values (Decimal or float)
+def get_portfolio_value(positions, values, number=Decimal):
+    total_value = number(0)
     for team, count in positions.items():
         if not count:
             continue
 
         if team == 'points':
-            total_value += Decimal(count)
+            total_value += number(count)
         else:
             try:
-                team_name = CIX_NAME_CONVERSIONS.get(team, team)
+                team_name = team_names.get_index().canonical('cix', team)
                 value = values[team_name]
             except KeyError:
                 print('missing team ' + team)
-                value = Decimal(0)
-            total_value += Decimal(value * count)
+                value = number(0)
+            total_value += number(value * count)
 
     return total_value
 
-TeamDelta = namedtuple("TeamDelta", ["team", "position", "delta_per_share", "total_delta"])
-
-def game_delta(positions, tournament, team1, team2):
-    original_override = tournament.overrides.get_override(team1, team2)
-
-    tournament.overrides.add_override(team1, team2, Decimal(1))
-    win_values = tournament.calculate_scores_prob()
-    win_portfolio = get_portfolio_value(positions, win_values)
+CompiledPositions = namedtuple("CompiledPositions", ["vector", "cash",
+    "counts"])
+
+# Resolves CIX position names once and lays the positions out along the
+# tournament's team index: vector holds share counts as floats, counts the
+# original counts, cash the 'points' balance plus the banked points of
+# shares in eliminated teams. The portfolio value of a (sims, teams) array of
+# scores is then scores @ vector + cash.
+def compile_positions(positions, tournament, names=None):
+    if names is None:
+        names = team_names.get_index()
+    index = tournament.engine.index
+    vector = np.zeros(len(index))
+    counts = [0] * len(index)
+    cash = float(positions.get('points', 0) or 0)
+    for team, count in positions.items():
+        if not count or team == 'points':
+            continue
+        team_name = names.canonical('cix', team)
+        i = index.get(team_name)
+        if i is not None:
+            vector[i] += float(count)
+            counts[i] += count
+        elif team_name in tournament.eliminated:
+            cash += float(count) * float(tournament.banked.get(team_name, 0))
+        else:
+            print('missing team ' + team)
+    return CompiledPositions(vector=vector, cash=cash, counts=counts)
+
+def get_position_vector(positions, tournament, names=None):
+    return compile_positions(positions, tournament, names).vector
+
+# Standard deviation of the portfolio's final value from the exact score
+# covariance: one quadratic form, no simulation
+def get_portfolio_std(compiled, tournament):
+    variance = compiled.vector @ tournament.score_covariance() @ \
+            compiled.vector
+    return float(np.sqrt(max(variance, 0.0)))
+
+RiskReport = namedtuple("RiskReport", ["mean", "minimum", "maximum",
+    "percentiles", "var", "cvar", "loss_prob"])
+
+# Summarizes simulated portfolio values. Losses are measured against baseline
+# (typically the analytic expected value): var is the loss not exceeded with
+# the given confidence, cvar the mean loss beyond it.
+def get_risk_report(values, baseline, percentiles=(1, 10, 25, 50, 75, 90, 99),
+        confidence=0.95):
+    values = np.asarray(values)
+    tail_value = np.quantile(values, 1 - confidence)
+    return RiskReport(
+        mean=float(values.mean()),
+        minimum=float(values.min()),
+        maximum=float(values.max()),
+        percentiles=dict((percentile, float(value)) for percentile, value in
+            zip(percentiles, np.percentile(values, percentiles))),
+        var=float(baseline - tail_value),
+        cvar=float(baseline - values[values <= tail_value].mean()),
+        loss_prob=float((values < baseline).mean())
+    )
 
-    tournament.overrides.add_override(team1, team2, Decimal(0))
-    loss_values = tournament.calculate_scores_prob()
-    loss_portfolio = get_portfolio_value(positions, loss_values)
+TeamDelta = namedtuple("TeamDelta", ["team", "position", "delta_per_share", "total_delta"])
 
-    if original_override:
-        tournament.overrides.add_override(team1, team2, original_override)
-    else:
-        tournament.overrides.remove_override(team1, team2)
+GameDelta = namedtuple("GameDelta", ["team1", "team2", "win_portfolio",
+    "loss_portfolio", "team_deltas"])
 
+def get_game_team_deltas(compiled, tournament, win_scores, loss_scores):
+    number = tournament.number
+    teams = tournament.engine.teams
     team_deltas = list()
-    for team, value in sorted(win_values.items(), key=(lambda kv: kv[0])):
-        position = positions.get(REVERSE_NAME_CONVERSIONS.get(team, team), 0)
-        delta_per_share = value - loss_values[team]
+    for i in sorted(range(len(teams)), key=teams.__getitem__):
+        position = compiled.counts[i]
+        delta_per_share = number(float(win_scores[i] - loss_scores[i]))
         team_deltas.append(TeamDelta(
-            team=team,
+            team=teams[i],
             position=position,
             delta_per_share= delta_per_share,
             total_delta= delta_per_share * position
         ))
 
-    return win_portfolio, loss_portfolio, team_deltas
+    return team_deltas
 
-def get_team_delta(tournament, team, point_delta=Decimal(1)):
-    point_adjustment = point_delta / tourney.AVG_SCORING
+# Portfolio and per-team values for both outcomes of every given game
+# ((team1, team2) pairs, or every pending game if None), computed together
+# without touching the tournament's overrides.
+def game_deltas(positions, tournament, games=None):
+    if games is None:
+        games = [game[:2] for game in tournament.pending_games()]
+    win_scores, loss_scores = tournament.game_outcome_scores(games)
+
+    compiled = compile_positions(positions, tournament)
+    win_portfolios = win_scores @ compiled.vector + compiled.cash
+    loss_portfolios = loss_scores @ compiled.vector + compiled.cash
+
+    number = tournament.number
+    results = []
+    for g, (team1, team2) in enumerate(games):
+        results.append(GameDelta(
+            team1=team1,
+            team2=team2,
+            win_portfolio=number(float(win_portfolios[g])),
+            loss_portfolio=number(float(loss_portfolios[g])),
+            team_deltas=get_game_team_deltas(compiled, tournament,
+                win_scores[g], loss_scores[g])
+        ))
 
+    return results
+
+ScenarioReport = namedtuple("ScenarioReport", ["games", "outcomes", "probs",
+    "values", "baseline", "expected", "worst", "best", "loss_prob"])
+
+# Portfolio value under every combination of outcomes of the given pending
+# games (all of them if None). outcomes, probs and values are one row per
+# scenario (see TournamentState.scenario_scores); worst and best are scenario
+# indices, expected the probability-weighted value and loss_prob the
+# probability of ending below the current (baseline) value.
+def scenario_report(positions, tournament, games=None):
+    if games is None:
+        games = [game[:2] for game in tournament.pending_games()]
+    outcomes, probs, scores = tournament.scenario_scores(games)
+
+    compiled = compile_positions(positions, tournament)
+    values = scores @ compiled.vector + compiled.cash
+    baseline = tournament.expected_scores() @ compiled.vector + compiled.cash
+
+    return ScenarioReport(
+        games=games,
+        outcomes=outcomes,
+        probs=probs,
+        values=values,
+        baseline=baseline,
+        expected=float(probs @ values),
+        worst=int(np.argmin(values)),
+        best=int(np.argmax(values)),
+        loss_prob=float(probs[values < baseline].sum()),
+    )
+
+# winners of each game in scenario s of a ScenarioReport
+def scenario_winners(report, s):
+    return [team1 if won else team2
+        for (team1, team2), won in zip(report.games, report.outcomes[s])]
+
+def game_delta(positions, tournament, team1, team2):
+    delta = game_deltas(positions, tournament, [(team1, team2)])[0]
+    return delta.win_portfolio, delta.loss_portfolio, delta.team_deltas
+
+def get_team_delta(tournament, team, point_delta=Decimal(1)):
     orig_team = tournament.ratings[team]
-    orig_offense = orig_team.offense
-    orig_defense = orig_team.defense
+
+    number = type(orig_team.offense)
+    point_adjustment = number(point_delta) / number(tourney.AVG_SCORING)
 
     positive_team = orig_team.copy()
     positive_team.offense += point_adjustment
     positive_team.defense -= point_adjustment
-    tournament.ratings[team] = positive_team
-    positive_scores = tournament.calculate_scores_prob()
+    positive_scores = tournament.calculate_scores_with(positive_team)
 
     negative_team = orig_team.copy()
     negative_team.offense -= point_adjustment
     negative_team.defense += point_adjustment
-    tournament.ratings[team] = negative_team
-    negative_scores = tournament.calculate_scores_prob()
-
-    tournament.ratings[team] = orig_team
+    negative_scores = tournament.calculate_scores_with(negative_team)
 
     return positive_scores, negative_scores
 
-def calculate_team_portfolio_delta(positions, positive_values, negative_values):
-    positive_value = get_portfolio_value(positions, positive_values)
-    negative_value = get_portfolio_value(positions, negative_values)
+def calculate_team_portfolio_delta(positions, positive_values, negative_values,
+        number=Decimal):
+    positive_value = get_portfolio_value(positions, positive_values, number)
+    negative_value = get_portfolio_value(positions, negative_values, number)
 
     return positive_value - negative_value
 
@@ -152,7 +378,7 @@ def get_team_portfolio_delta(positions, tournament, team,
             point_delta=point_delta)
     
     return calculate_team_portfolio_delta(positions, positive_values,
-            negative_values)
+            negative_values, tournament.number)
 
 def calculate_team_pairwise_deltas(positive_values, negative_values):
     team_deltas = {}
@@ -181,14 +407,137 @@ def get_all_team_deltas(positions, tournament, point_delta=Decimal(1)):
                 point_delta=point_delta)
 
         team_deltas[team] = calculate_team_portfolio_delta(positions,
-                positive_values, negative_values)
+                positive_values, negative_values, tournament.number)
         pairwise_deltas[team] = calculate_team_pairwise_deltas(positive_values,
                 negative_values)
 
+        profiling.count('deltas_computed')
         print('computed deltas for {0}'.format(team))
 
     return team_deltas, pairwise_deltas
 
+# Worker-side state for get_all_team_deltas_parallel: the arrays live in one
+# shared memory block that every worker attaches to once at startup.
+_delta_worker = None
+
+def _share_arrays(arrays):
+    size = sum(array.nbytes for array in arrays.values())
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    layout = []
+    offset = 0
+    for name, array in arrays.items():
+        view = np.ndarray(array.shape, array.dtype, buffer=shm.buf,
+                offset=offset)
+        view[...] = array
+        layout.append((name, array.shape, array.dtype, offset))
+        offset += array.nbytes
+    return shm, layout
+
+def _attach_arrays(shm_name, layout):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    arrays = dict((name, np.ndarray(shape, dtype, buffer=shm.buf,
+            offset=offset)) for name, shape, dtype, offset in layout)
+    return shm, arrays
+
+def _init_delta_worker(shm_name, layout, teams, num_leaves, scoring,
+        forfeit_prob, point_adjustment):
+    global _delta_worker
+    shm, arrays = _attach_arrays(shm_name, layout)
+    engine = tourney.BracketEngine.from_arrays(teams, arrays['leaves'],
+            arrays['initial'], num_leaves, scoring)
+    round_matrices = engine.round_matrices(arrays['win_probs'])
+    reach = engine.advance(round_matrices)
+    _delta_worker = (shm, engine, arrays, reach, round_matrices,
+            engine.win_rates(round_matrices, reach), forfeit_prob,
+            point_adjustment)
+
+def _team_delta_job(i):
+    _, engine, arrays, reach, round_matrices, win_rates, forfeit_prob, \
+            point_adjustment = _delta_worker
+    ratings = arrays['ratings']
+    offense, defense, tempo = ratings['offense'], ratings['defense'], \
+            ratings['tempo']
+
+    scores = []
+    for sign in (1, -1):
+        row = tourney.calculate_win_probs(
+                offense[i] + sign * point_adjustment,
+                defense[i] - sign * point_adjustment, tempo[i],
+                offense, defense, tempo, forfeit_prob)
+        row = tourney.replace_team_row(arrays['win_probs'],
+                arrays['overridden'], i, row)
+        new_reach = engine.readvance_team(reach, round_matrices, win_rates,
+                i, row)
+        scores.append(engine.expected_scores(new_reach))
+
+    pairwise = scores[0] - scores[1]
+    return i, pairwise, float(arrays['positions'] @ pairwise)
+
+# Finite-difference deltas (as get_all_team_deltas) with the per-team bumps
+# spread over a process pool. Ratings, bracket, overrides and positions are
+# written once to shared memory instead of being pickled for every task.
+def get_all_team_deltas_parallel(positions, tournament, point_delta=Decimal(1),
+        workers=None, teams=None):
+    engine = tournament.engine
+    if not teams:
+        teams = engine.teams
+    arrays = {
+        'win_probs': tournament.win_prob_matrix(),
+        'ratings': tournament.team_ratings(),
+        'initial': engine.initial,
+        'positions': get_position_vector(positions, tournament),
+        'leaves': engine.leaves,
+        'overridden': tournament.override_mask(),
+    }
+    point_adjustment = float(point_delta) / float(tourney.AVG_SCORING)
+
+    team_deltas = {}
+    pairwise_deltas = {}
+    shm, layout = _share_arrays(arrays)
+    try:
+        with ProcessPoolExecutor(max_workers=workers,
+                initializer=_init_delta_worker,
+                initargs=(shm.name, layout, engine.teams, engine.num_leaves,
+                    engine.scoring, tournament.forfeit_prob,
+                    point_adjustment)) as executor:
+            jobs = [engine.index[team] for team in teams]
+            chunksize = max(1, len(jobs) // (4 * (workers or 1)))
+            for i, pairwise, portfolio in executor.map(_team_delta_job, jobs,
+                    chunksize=chunksize):
+                team = engine.teams[i]
+                team_deltas[team] = tournament.number(portfolio)
+                pairwise_deltas[team] = dict((other,
+                        tournament.number(float(delta)))
+                        for other, delta in zip(engine.teams, pairwise))
+                profiling.count('deltas_computed')
+                print('computed deltas for {0}'.format(team))
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return team_deltas, pairwise_deltas
+
+# Same output as get_all_team_deltas, but from exact rating derivatives: a
+# +/- point_delta bump moves each score by 2 * point_delta / AVG_SCORING times
+# the derivative along (offense + 1, defense - 1).
+def get_all_team_deltas_analytic(positions, tournament, point_delta=Decimal(1)):
+    d_offense, d_defense = tournament.rating_sensitivities()
+    scale = 2 * float(point_delta) / float(tourney.AVG_SCORING)
+    pairwise = scale * (d_offense - d_defense)
+    portfolio = get_position_vector(positions, tournament) @ pairwise
+
+    team_deltas = {}
+    pairwise_deltas = {}
+    teams = tournament.engine.teams
+    for k, team in enumerate(teams):
+        team_deltas[team] = tournament.number(float(portfolio[k]))
+        pairwise_deltas[team] = dict((other,
+                tournament.number(float(pairwise[i, k])))
+                for i, other in enumerate(teams))
+
+    profiling.count('deltas_computed', len(teams))
+    return team_deltas, pairwise_deltas
+
 if __name__ == '__main__':
     positions = get_positions(API_KEY)
     with open(sys.argv[1], 'r') as values_file:
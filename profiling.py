@@ -0,0 +1,75 @@
+import atexit
+from collections import defaultdict
+import json
+import sys
+import time
+
+# Counters and timers for the hot paths. Everything is a no-op until enable()
+# is called; hot loops check ENABLED themselves before doing any timing.
+ENABLED = False
+
+_counters = defaultdict(int)
+_timers = defaultdict(lambda: [0, 0.0, 0.0])
+_started = None
+
+
+def count(name, amount=1):
+    if ENABLED:
+        _counters[name] += amount
+
+
+def record(name, seconds):
+    if ENABLED:
+        entry = _timers[name]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+
+
+# with timer("name"): ... adds the block's wall time to the named timer
+class Timer:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if ENABLED:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if ENABLED:
+            record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def timer(name):
+    return Timer(name)
+
+
+def report():
+    return {
+        "wall": time.perf_counter() - _started if _started is not None else 0.0,
+        "counters": dict(sorted(_counters.items())),
+        "timers": dict(
+            (name, {"count": calls, "total": total, "max": longest})
+            for name, (calls, total, longest) in sorted(_timers.items())
+        ),
+    }
+
+
+def dump(path="-"):
+    if path == "-":
+        json.dump(report(), sys.stderr, indent=1)
+        sys.stderr.write("\n")
+    else:
+        with open(path, "w") as out_file:
+            json.dump(report(), out_file, indent=1)
+
+
+# Turns instrumentation on and writes the report as JSON to path ('-' for
+# stderr) when the process exits, so long-running modes report on ctrl-c too
+def enable(path="-"):
+    global ENABLED, _started
+    ENABLED = True
+    _started = time.perf_counter()
+    atexit.register(dump, path)
@@ -0,0 +1,248 @@
+import hashlib
+import json
+import re
+
+ALIASES_PATH = "aliases.json"
+
+NAME_CONVERSIONS = {
+    "Miami": "Miami FL",
+    "Southern Cal": "USC",
+    "St. Mary's (ca)": "Saint Mary's",
+    "Virginia Commonwealth": "VCU",
+    "Miami (fl)": "Miami FL",
+    "Middle Tennessee St.": "Middle Tennessee",
+    "Se Louisiana": "Southeastern Louisiana",
+    "Arkansas-pine Bluff": "Arkansas Pine Bluff",
+    "Louisiana": "Louisiana Lafayette",
+    "Charleston": "College of Charleston",
+    "Nc St.": "North Carolina St.",
+    "Texas A&m;": "Texas A&M;",
+    "Loyola-chicago": "Loyola Chicago",
+    "Cs Fullerton": "Cal St. Fullerton",
+    "Csu Fullerton": "Cal St. Fullerton",
+    "Suny-buffalo": "Buffalo",
+    "Md-baltimore County": "UMBC",
+    "Texas Am": "Texas A&M;",
+    "Pennsylvania": "Penn",
+    "College Of Charleston": "College of Charleston",
+    "Texas Christian": "TCU",
+    "Ole Miss": "Mississippi",
+    "Gardner-webb": "Gardner Webb",
+    "Texas So.": "Texas Southern",
+    "UCSB": "UC Santa Barbara",
+    "E. Washington": "Eastern Washington",
+    "Uconn": "Connecticut",
+    "Uncg": "UNC Greensboro",
+    "Louisiana St.": "LSU",
+    "Texas A&m-cc": "Texas A&M Corpus Chris",
+    "Loyola (chi)": "Loyola Chicago",
+    "Se Missourist.": "Southeast Missouri St.",
+    "Fdu": "Fairleigh Dickinson",
+    "Tamu-cc": "Texas A&M Corpus Chris",
+    "North Carolina St.": "N.C. State",
+    "College of Charleston": "Charleston",
+    "Louisiana Lafayette": "Louisiana",
+    "Fla. Atlantic": "Florida Atlantic",
+    "No. Kentucky": "Northern Kentucky",
+}
+
+WORD_ABBREVS = set(
+    [
+        "Unc",
+        "Ucla",
+        "Smu",
+        "Vcu",
+        "Uc",
+        "Tcu",
+        "Liu",
+        "Usc",
+        "A&m",
+        "A&m;",
+        "Lsu",
+        "Ucf",
+        "Ucsb",
+        "Byu",
+        "Uab",
+    ]
+)
+
+WORD_CONVERSIONS = {
+    "State": "St.",
+    "St": "St.",
+    "Marys": "Mary's",
+}
+
+
+def clean_name(s):
+    s = s.replace("aq - ", "").replace(" - aq", "")
+    words = s.split()
+    for i in range(len(words)):
+        word = words[i].lower()
+        word = word[0].upper() + word[1:].lower()
+        if word in WORD_ABBREVS:
+            word = word.upper()
+        word = WORD_CONVERSIONS.get(word, word)
+        words[i] = word
+    cleaned = " ".join(words)
+    return NAME_CONVERSIONS.get(cleaned, cleaned)
+
+
+def clean_api_name(s):
+    words = s.split()
+
+    # remove at least one word of team name
+    words = words[:-1]
+
+    if words[-1] in (
+        "Blue",
+        "Tar",
+        "Red",
+        "Fighting",
+        "Scarlet",
+        "Horned",
+        "Golden",
+        "Crimson",
+    ):
+        words = words[:-1]
+
+    return clean_name(" ".join(words))
+
+
+# why do i do this to myself
+CIX_NAME_CONVERSIONS = {
+    "Michigan State": "Michigan St.",
+    "Southern California": "USC",
+    "Middle Tennessee State": "Middle Tennessee",
+    "Miami": "Miami FL",
+    "Iowa State": "Iowa St.",
+    "Kent State": "Kent St.",
+    "Nevada Reno": "Nevada",
+    "Virginia Commonwealth": "VCU",
+    "California Davis": "UC Davis",
+    "Wichita State": "Wichita St.",
+    "Florida State": "Florida St.",
+    "Alabma": "Alabama",
+    "Abilene Chrsitian": "Abilene Christian",
+    "Ohio University": "Ohio",
+    "Brigham Young": "BYU",
+    "Oregon State": "Oregon St.",
+    "Oklahoma State": "Oklahoma St.",
+}
+
+CIX_ORDER_NAMES = {
+    "Miami FL": "Miami (FL)",
+    "Texas A&M Corpus Chris": "Texas A&M Corpus Christi",
+    "Cal St. Fullerton": "CSU Fullerton",
+}
+
+
+def cix_order_name(name):
+    try:
+        return CIX_ORDER_NAMES[name]
+    except KeyError:
+        pass
+
+    name = re.sub(r"St\.$", "State", name)
+    name = re.sub("^Saint", "St.", name)
+
+    return name
+
+
+# how a name from each source is turned into the canonical (KenPom) name
+NORMALIZERS = {
+    "kenpom": lambda name: name,
+    "espn": clean_name,
+    "odds": clean_api_name,
+    "cix": lambda name: CIX_NAME_CONVERSIONS.get(name, name),
+    "gamepredict": lambda name: name,
+}
+
+# how a canonical name is written for sources that need names sent back
+EXPORTERS = {
+    "cix_orders": cix_order_name,
+}
+
+# changes whenever the conversion tables do, so a persisted index built from
+# older tables gets thrown away
+TABLES_VERSION = hashlib.sha1(
+    json.dumps(
+        [
+            NAME_CONVERSIONS,
+            sorted(WORD_ABBREVS),
+            WORD_CONVERSIONS,
+            CIX_NAME_CONVERSIONS,
+            CIX_ORDER_NAMES,
+        ],
+        sort_keys=True,
+    ).encode()
+).hexdigest()
+
+
+# Resolves team names from every source namespace to one canonical name.
+# Each raw name is normalized once and remembered, and the remembered
+# aliases can be saved and reloaded between runs.
+class NameIndex:
+    def __init__(self, aliases=None):
+        self.aliases = dict((namespace, {}) for namespace in NORMALIZERS)
+        self.aliases["cix"].update(CIX_NAME_CONVERSIONS)
+        for namespace, names in (aliases or {}).items():
+            self.aliases.setdefault(namespace, {}).update(names)
+        self._reverse = {}
+        self.changed = False
+
+    def canonical(self, namespace, name):
+        names = self.aliases[namespace]
+        try:
+            return names[name]
+        except KeyError:
+            canonical = names[name] = NORMALIZERS[namespace](name)
+            self._reverse.pop(namespace, None)
+            self.changed = True
+            return canonical
+
+    # the name a source uses for a canonical team: its exporter if it has one,
+    # otherwise the alias recorded for that team, otherwise the name itself
+    def external(self, namespace, canonical):
+        if namespace in EXPORTERS:
+            return EXPORTERS[namespace](canonical)
+        reverse = self._reverse.get(namespace)
+        if reverse is None:
+            reverse = self._reverse[namespace] = dict(
+                (target, name)
+                for name, target in self.aliases[namespace].items()
+                if name != target
+            )
+        return reverse.get(canonical, canonical)
+
+    def save(self, path=ALIASES_PATH):
+        with open(path, "w") as aliases_file:
+            json.dump(
+                {"version": TABLES_VERSION, "aliases": self.aliases},
+                aliases_file,
+                indent=1,
+                sort_keys=True,
+            )
+        self.changed = False
+
+    @classmethod
+    def load(cls, path=ALIASES_PATH):
+        try:
+            with open(path, "r") as aliases_file:
+                data = json.load(aliases_file)
+        except FileNotFoundError:
+            return cls()
+
+        if data.get("version") != TABLES_VERSION:
+            return cls()
+        return cls(data["aliases"])
+
+
+_index = None
+
+
+# the process-wide index, loaded from ALIASES_PATH on first use
+def get_index():
+    global _index
+    if _index is None:
+        _index = NameIndex.load()
+    return _index
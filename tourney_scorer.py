@@ -4,11 +4,17 @@ import argparse
 from collections import defaultdict
 from decimal import Decimal
 from dotenv import load_dotenv
+import numpy as np
 import os
 import sys
+import time
 
 import cix_client
+import get_data
+import http_cache
 import portfolio_value as pv
+import profiling
+import team_names
 import tourney_utils as tourney
 
 load_dotenv()
@@ -16,7 +22,87 @@ load_dotenv()
 
 def get_positions():
     client = cix_client.CixClient(os.getenv("CIX_APID"))
-    return client.my_positions()
+    return client.my_positions(full_names=True)
+
+
+# seconds between prunes of the http cache while watching odds
+CACHE_PRUNE_INTERVAL = 3600
+
+
+# Polls the odds feed and streams every line move into state's overrides.
+# Only the slots above the moved games are recomputed, after which the teams
+# whose expected scores moved (and the portfolio, if positions are given)
+# are printed. Lines that drop off the feed go back to the override state
+# had when watching started (from the overrides files), or to the ratings
+# model if there was none.
+def watch_odds(state, interval, positions=None, tolerance=5e-4):
+    names = team_names.get_index()
+    cache = http_cache.HttpCache()
+    last_prune = time.time()
+    compiled = pv.compile_positions(positions, state) if positions else None
+    file_overrides = dict(
+        ((name1, name2), prob) for name1, name2, prob in state.overrides.items()
+    )
+    current = {}
+    values = state.expected_scores()
+
+    while True:
+        try:
+            new_odds = get_data.get_odds(names, cache, max_age=0)
+        except Exception as e:
+            sys.stderr.write("odds fetch failed: {0}\n".format(e))
+            new_odds = current
+
+        start = time.perf_counter()
+        rows = []
+        for teams, win_prob in new_odds.items():
+            win_prob = round(win_prob, 3)
+            if current.get(teams) != win_prob:
+                print(
+                    "{0}-{1} {2} (was {3})".format(
+                        teams[0], teams[1], win_prob, current.get(teams)
+                    )
+                )
+                rows.append((teams[0], teams[1], win_prob))
+        for teams in set(current) - set(new_odds):
+            print("{0}-{1} off the board".format(teams[0], teams[1]))
+            if teams[::-1] in file_overrides:
+                teams = teams[::-1]
+            rows.append((teams[0], teams[1], file_overrides.get(teams)))
+
+        if rows:
+            state.update_overrides(rows)
+            current = dict(
+                (teams, round(win_prob, 3)) for teams, win_prob in new_odds.items()
+            )
+            new_values = state.expected_scores()
+            for i in np.flatnonzero(np.abs(new_values - values) >= tolerance):
+                print(
+                    "{0},{1:.3f} ({2:+.3f})".format(
+                        state.engine.teams[i], new_values[i], new_values[i] - values[i]
+                    )
+                )
+            if compiled:
+                print(
+                    "portfolio value: {0:.2f} ({1:+.2f})".format(
+                        new_values @ compiled.vector + compiled.cash,
+                        (new_values - values) @ compiled.vector,
+                    )
+                )
+            values = new_values
+            print(
+                "revalued {0} games in {1:.1f} ms".format(
+                    len(rows), 1000 * (time.perf_counter() - start)
+                )
+            )
+            sys.stdout.flush()
+
+        if names.changed:
+            names.save()
+        if time.time() - last_prune >= CACHE_PRUNE_INTERVAL:
+            cache.prune()
+            last_prune = time.time()
+        time.sleep(interval)
 
 
 if __name__ == "__main__":
@@ -24,21 +110,45 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "operation",
-        choices=["expected", "portfolio_simulate", "portfolio_expected", "sim_game"],
+        choices=[
+            "expected",
+            "portfolio_simulate",
+            "portfolio_expected",
+            "sim_game",
+            "compare_backends",
+            "watch_odds",
+        ],
     )
     parser.add_argument("bracket_file")
     parser.add_argument("ratings_file")
     parser.add_argument("teams", nargs="*")
     parser.add_argument("--adjustments", action="store")
     parser.add_argument("--overrides", action="append")
+    parser.add_argument("--results", action="append")
     parser.add_argument(
         "--sort", action="store", default="name", choices=["name", "score"]
     )
     parser.add_argument("--calcutta", action="store_true")
     parser.add_argument("--simulations", action="store", type=int, default=10000)
+    parser.add_argument("--confidence", action="store", type=float, default=0.95)
     parser.add_argument("--forfeit_prob", action="store", type=float, default=0.0)
+    parser.add_argument(
+        "--backend", action="store", default="float", choices=tourney.BACKENDS
+    )
+    parser.add_argument("--tolerance", action="store", type=float, default=1e-9)
+    parser.add_argument("--interval", action="store", type=float, default=60.0)
+    parser.add_argument("--portfolio", action="store_true")
+    parser.add_argument("--profile", nargs="?", const="-", metavar="PATH")
     args = parser.parse_args()
 
+    if args.profile:
+        profiling.enable(args.profile)
+
+    if args.operation == "compare_backends":
+        # the reference evaluator needs Decimal ratings
+        args.backend = "decimal"
+    number = tourney.BACKENDS[args.backend]
+
     if args.sort == "name":
         sorter = lambda g: g[0]
     elif args.sort == "score":
@@ -49,7 +159,7 @@ if __name__ == "__main__":
 
     if args.adjustments:
         with open(args.adjustments, "r") as adjustments_file:
-            adjustments = tourney.read_adjustments_file(adjustments_file)
+            adjustments = tourney.read_adjustments_file(adjustments_file, number)
     else:
         adjustments = {}
 
@@ -58,7 +168,7 @@ if __name__ == "__main__":
         exit(1)
 
     with open(args.ratings_file, "r") as ratings_file:
-        ratings = tourney.read_ratings_file(ratings_file, adjustments)
+        ratings = tourney.read_ratings_file(ratings_file, adjustments, number)
 
     if args.calcutta:
         scoring = tourney.CALCUTTA_POINTS
@@ -69,7 +179,7 @@ if __name__ == "__main__":
     if args.overrides:
         for overrides_file in args.overrides:
             overrides.read_from_file(overrides_file)
-    games = tourney.read_games_from_file(args.bracket_file, ratings, overrides)
+    games = tourney.read_games_from_file(args.bracket_file, ratings, overrides, number)
 
     state = tourney.TournamentState(
         bracket=games,
@@ -77,12 +187,20 @@ if __name__ == "__main__":
         scoring=scoring,
         overrides=overrides,
         forfeit_prob=args.forfeit_prob,
+        backend=args.backend,
     )
 
+    if args.results:
+        results = [
+            row for path in args.results for row in tourney.read_results_file(path)
+        ]
+        for winner, loser in state.apply_results(results):
+            sys.stderr.write("{0} over {1} is not a game yet\n".format(winner, loser))
+
     if args.operation == "expected":
         team_scores = state.calculate_scores_prob()
 
-        total_score = Decimal(0.0)
+        total_score = number(0)
 
         for team, win_prob in sorted(team_scores.items(), key=sorter):
             # print(",".join((team, str(round(win_prob, 3)))))
@@ -91,33 +209,59 @@ if __name__ == "__main__":
 
         print(total_score)
     elif args.operation == "portfolio_simulate":
-        positions = pv.get_positions(API_KEY)
-        portfolio_values = []
-        for i in range(args.simulations):
-            scores = state.calculate_scores_sim()
-            values = pv.get_portfolio_value(positions, scores)
-            portfolio_values.append(values)
-        portfolio_values = sorted(portfolio_values)
-        percentiles = [1, 10, 25, 50, 75, 90, 99]
-        print("min value: {0}".format(portfolio_values[0]))
-        for percentile in percentiles:
-            print(
-                "{0} percentile value: {1}".format(
-                    percentile, portfolio_values[(percentile * args.simulations) / 100]
-                )
-            )
-        print("max value: {0}".format(portfolio_values[-1]))
+        positions = get_positions()
+        compiled = pv.compile_positions(positions, state)
+        portfolio_values = np.concatenate(
+            [
+                scores @ compiled.vector + compiled.cash
+                for scores in state.iter_simulated_scores(args.simulations)
+            ]
+        )
+        expected_value = state.expected_scores() @ compiled.vector + compiled.cash
+        report = pv.get_risk_report(
+            portfolio_values, expected_value, confidence=args.confidence
+        )
+        print("expected value: {0:.2f}".format(expected_value))
+        print(
+            "standard deviation: {0:.2f}".format(pv.get_portfolio_std(compiled, state))
+        )
+        print("mean simulated value: {0:.2f}".format(report.mean))
+        print("simulated standard deviation: {0:.2f}".format(portfolio_values.std()))
+        print("min value: {0:.2f}".format(report.minimum))
+        for percentile, value in report.percentiles.items():
+            print("{0} percentile value: {1:.2f}".format(percentile, value))
+        print("max value: {0:.2f}".format(report.maximum))
+        print("{0:.0%} VaR: {1:.2f}".format(args.confidence, report.var))
+        print("{0:.0%} CVaR: {1:.2f}".format(args.confidence, report.cvar))
+        print("probability of loss: {0:.3f}".format(report.loss_prob))
     elif args.operation == "portfolio_expected":
-        pass
-    elif args.operation == "sim_game":
+        compiled = pv.compile_positions(get_positions(), state)
+        expected_value = state.expected_scores() @ compiled.vector + compiled.cash
+        print("expected value: {0:.2f}".format(expected_value))
         print(
-            tourney.calculate_win_prob(
-                state.ratings[args.teams[0]],
-                state.ratings[args.teams[1]],
-                overrides=overrides,
-            ).quantize(Decimal("0.001"))
+            "standard deviation: {0:.2f}".format(pv.get_portfolio_std(compiled, state))
+        )
+    elif args.operation == "sim_game":
+        win_prob = tourney.calculate_win_prob(
+            state.ratings[args.teams[0]],
+            state.ratings[args.teams[1]],
+            overrides=overrides,
         )
+        print(Decimal(win_prob).quantize(Decimal("0.001")))
+    elif args.operation == "compare_backends":
+        difference = state.compare_backends(args.tolerance)
+        print("max difference: {0:.3g}".format(difference))
+    elif args.operation == "watch_odds":
+        if args.backend != "float":
+            sys.stderr.write("watch_odds needs the float backend\n")
+            exit(1)
+        try:
+            watch_odds(
+                state, args.interval, get_positions() if args.portfolio else None
+            )
+        except KeyboardInterrupt:
+            pass
     else:
         print("invalid operation")
 
-    print("{0} overrides used".format(tourney.overrides_used))
+    print("{0} overrides used".format(overrides.hits))
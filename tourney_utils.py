@@ -1,12 +1,17 @@
 from collections import defaultdict, namedtuple
 import csv
 from decimal import Decimal
-import random
+import numpy as np
+import os
+from scipy.special import ndtr
 from scipy.stats import norm
 import sys
+import time
 
-DEBUG_PRINT = False
-#DEBUG_PRINT = True
+import profiling
+
+# set TOURNEY_DEBUG in the environment to trace the dict-walking evaluator
+DEBUG_PRINT = bool(os.getenv('TOURNEY_DEBUG'))
 
 AVG_SCORING = Decimal('104.6')
 AVG_TEMPO = Decimal('67.7')
@@ -17,16 +22,62 @@ ROUND_POINTS = [1, 1, 2, 2, 2, 3]
 CALCUTTA_POINTS = map(Decimal, [0.5, 1.25, 2.5, 7.75, 3, 7])
 CALCUTTA_POINTS = [Decimal(15.5) * x for x in CALCUTTA_POINTS]
 
-total_overrides = 0
-overrides_used = 0
+# fields larger than this use BlockEngine, which never holds a teams x teams
+# array but only supports expected scores
+DENSE_MAX_TEAMS = 2048
+# pairs evaluated at once by BlockEngine
+BLOCK_CHUNK_SIZE = 1 << 20
+
+# scenario_scores evaluates 2^games scenarios, each a row of every (2^games,
+# teams) array it builds; this bounds the table size (35 MB per array for 16
+# games of a 68 team field)
+MAX_SCENARIO_GAMES = 16
+
+# numeric type for ratings and results under each backend. 'float' runs
+# everything through the array engine; 'decimal' keeps the original
+# dict-walking evaluator as a reference.
+BACKENDS = {
+    'float': float,
+    'decimal': Decimal,
+}
+
+# Interns team names to dense integer ids at load time, so that everything
+# past the readers can index arrays instead of hashing names.
+class TeamRegistry:
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, name):
+        team_id = self.ids.get(name)
+        if team_id is None:
+            team_id = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return team_id
+
+    def lookup(self, names):
+        return np.array([self.ids[name] for name in names], dtype=int)
+
+
+REGISTRY = TeamRegistry()
+
+RATING_DTYPE = np.dtype([('offense', float), ('defense', float),
+    ('tempo', float)])
+
 
 class Team:
+    __slots__ = ('name', 'offense', 'defense', 'tempo')
+
     def __init__(self, name, offense, defense, tempo, adjust=False):
         self.name = name
         self.offense, self.defense, self.tempo = offense, defense, tempo
         if adjust:
-            self.offense = (self.offense / AVG_SCORING) - 1
-            self.defense = (self.defense / AVG_SCORING) - 1
+            avg_scoring = type(self.offense)(AVG_SCORING)
+            self.offense = (self.offense / avg_scoring) - 1
+            self.defense = (self.defense / avg_scoring) - 1
         if DEBUG_PRINT:
             #print('\t\t'.join(map(str, (self.name, self.offense, self.defense, self.tempo))))
             pass
@@ -37,36 +88,100 @@ class Team:
     def __str__(self):
         return '{0}: {1} | {2} | {3}'.format(self.name, self.offense, self.defense, self.tempo)
 
+# The name -> Team mapping returned by read_ratings_file. Every assignment is
+# mirrored into a structured array of ratings indexed by registry id, which
+# is what the engines read. Replace entries rather than editing a Team in
+# place so the two stay in sync.
+class Ratings(dict):
+    def __init__(self, registry=None):
+        dict.__init__(self)
+        self.registry = registry if registry is not None else REGISTRY
+        self.array = np.zeros(len(self.registry), dtype=RATING_DTYPE)
+        self.revision = 0
+
+    def __setitem__(self, name, team):
+        team_id = self.registry.intern(name)
+        if team_id >= len(self.array):
+            grown = np.zeros(max(len(self.registry), 2 * len(self.array)),
+                dtype=RATING_DTYPE)
+            grown[:len(self.array)] = self.array
+            self.array = grown
+        self.array[team_id] = (float(team.offense), float(team.defense),
+            float(team.tempo))
+        dict.__setitem__(self, name, team)
+        self.revision += 1
+
+
 class OverridesMap:
-    _overrides = {}
+    def __init__(self):
+        self._overrides = {}
+        # bumped on every change so cached probability matrices can tell when
+        # they are stale
+        self.revision = 0
+        # overrides found by get_override or written into a matrix by
+        # apply_overrides
+        self.hits = 0
+        self._compiled = None
+
+    def __len__(self):
+        return len(self._overrides)
 
     def read_from_file(self, filepath):
-        global total_overrides
         with open(filepath, "rt") as overrides_file:
-            reader = csv.reader(overrides_file)
-            for row in reader:
-                if not row:
-                    continue
-                assert len(row) == 3
-                row[2] = Decimal(row[2])
-                self.add_override(*row)
-                total_overrides += 1
+            rows = [row for row in csv.reader(overrides_file) if row]
+        assert all(len(row) == 3 for row in rows)
+        self.add_overrides((name1, name2, Decimal(prob))
+            for name1, name2, prob in rows)
 
-    def add_override(self, name1, name2, prob):
+    def _set(self, name1, name2, prob):
         if name1 < name2:
             self._overrides[(name1, name2)] = prob
         else:
             self._overrides[(name2, name1)] = 1 - prob
 
+    def add_override(self, name1, name2, prob):
+        self._set(name1, name2, prob)
+        self.revision += 1
+
+    # bulk form of add_override for (name1, name2, prob) rows
+    def add_overrides(self, rows):
+        for name1, name2, prob in rows:
+            self._set(name1, name2, prob)
+        self.revision += 1
+
     def remove_override(self, name1, name2):
         if name1 < name2:
             del self._overrides[(name1, name2)]
         else:
             del self._overrides[(name2, name1)]
+        self.revision += 1
+
+    def items(self):
+        for (name1, name2), prob in self._overrides.items():
+            yield name1, name2, prob
+
+    # Overrides between teams in index (a name -> position dict) as arrays
+    # (rows, cols, probs), with probs[k] the probability that team rows[k]
+    # beats team cols[k]. Kept until the overrides or the index change.
+    def compile(self, index):
+        if self._compiled is not None:
+            compiled_index, revision, arrays = self._compiled
+            if compiled_index is index and revision == self.revision:
+                return arrays
+
+        rows, cols, probs = [], [], []
+        for (name1, name2), prob in self._overrides.items():
+            i, j = index.get(name1), index.get(name2)
+            if i is not None and j is not None:
+                rows.append(i)
+                cols.append(j)
+                probs.append(float(prob))
+        arrays = (np.array(rows, dtype=int), np.array(cols, dtype=int),
+            np.array(probs))
+        self._compiled = (index, self.revision, arrays)
+        return arrays
 
     def get_override(self, name1, name2):
-        global total_overrides
-        global overrides_used
         if name1 < name2:
             override = self._overrides.get((name1, name2), None)
         else:
@@ -74,8 +189,8 @@ class OverridesMap:
             if override is not None:
                 override = 1 - override
         if override is not None:
-            total_overrides -= 1
-            overrides_used += 1
+            self.hits += 1
+            profiling.count('override_hits')
             if DEBUG_PRINT:
                 sys.stderr.write('using override for {0} vs. {1}\n'.format(
                     name1, name2))
@@ -83,7 +198,11 @@ class OverridesMap:
 
 
 def game_transform_prob(child1, child2, teams, overrides, forfeit_prob):
-    parent = defaultdict(lambda: Decimal(0))
+    # an empty side (see collapse_bracket) is a bye
+    if not child1 or not child2:
+        return defaultdict(int, child1 or child2)
+
+    parent = defaultdict(int)
 
     for team_name1, win1 in child1.items():
         team1 = teams[team_name1]
@@ -97,45 +216,922 @@ def game_transform_prob(child1, child2, teams, overrides, forfeit_prob):
     return parent
 
 
-def game_transform_sim(child1, child2, teams, overrides, forfeit_prob):
-    assert len(child1) == 1 and len(child2) == 1
-    team_name1 = child1.keys()[0]
-    team_name2 = child2.keys()[0]
+# Dense-array form of a bracket. Teams are indexed in bracket order, so every
+# slot of every round covers a contiguous range of the index and a whole round
+# fits in one array: reach[r][i] is the probability that team i wins its first
+# r games (reach[0] holds the leaf and play-in probabilities). Advancing a
+# round is one product against that round's slice of the pairwise win
+# probability matrix.
+#
+# Empty leaves (teams eliminated before a bracket was collapsed, see
+# collapse_bracket) give byes: reach[r + 1] = reach[r] * (Q reach[r] + b),
+# with b[i] = 1 where the other half of team i's slot is empty. banked maps
+# team names to points already earned, which are added to every score.
+class BracketEngine:
+    def __init__(self, bracket, scoring, banked=None):
+        teams, leaves, initial = bracket_arrays(bracket)
+        self._setup(teams, leaves, initial, len(bracket), scoring, banked)
 
-    team1 = teams[team_name1]
-    team2 = teams[team_name2]
+    # rebuilds an engine from the arrays of another one (e.g. in a worker
+    # process) without going through the bracket dicts
+    @classmethod
+    def from_arrays(cls, teams, leaves, initial, num_leaves, scoring,
+            banked=None):
+        engine = cls.__new__(cls)
+        engine._setup(teams, leaves, initial, num_leaves, scoring, banked)
+        return engine
 
-    team1_forfeit = random.random() < forfeit_prob
-    team2_forfeit = random.random() < forfeit_prob
+    def _setup(self, teams, leaves, initial, num_leaves, scoring, banked):
+        self.teams = list(teams)
+        self.index = dict((team_name, i) for i, team_name in enumerate(self.teams))
+        self.leaves = np.array(leaves, dtype=int)
+        self.initial = np.array(initial, dtype=float)
+        self.num_leaves = int(num_leaves)
+        self.num_rounds = self.num_leaves.bit_length() - 1
+        self.scoring = round_scoring(scoring, self.num_rounds)
+        self.banked = banked_array(self.teams, banked)
 
-    if team1_forfeit:
-        if team2_forfeit:
-            return { None: Decimal(1) }
-        else:
-            return { team_name2 : Decimal(1) }
-    if team2_forfeit:
-        return {team_name1: Decimal(1) }
+        # two teams meet in the round given by the highest bit in which their
+        # leaf positions differ (-1 for teams sharing a play-in leaf)
+        _, exponent = np.frexp(self.leaves[:, None] ^ self.leaves[None, :])
+        self.meet_round = exponent - 1
+        self.round_masks = np.stack([self.meet_round == r
+            for r in range(self.num_rounds)])
+
+        self.slot_bounds = slot_bounds(self.leaves, self.num_leaves)
+        self.byes = bye_rounds(self.leaves, self.slot_bounds)
+
+        # leaves holding more than one team (play-ins) or none
+        self.shared_leaves = np.flatnonzero(np.diff(self.slot_bounds[0]) > 1)
+        self.empty_leaves = np.flatnonzero(np.diff(self.slot_bounds[0]) == 0)
+
+    def round_matrices(self, win_probs):
+        return self.round_masks * win_probs
+
+    def advance(self, round_matrices):
+        reach = [self.initial]
+        for r, matrix in enumerate(round_matrices):
+            if profiling.ENABLED:
+                start = time.perf_counter()
+            reach.append(reach[-1] * (matrix @ reach[-1] + self.byes[r]))
+            if profiling.ENABLED:
+                profiling.record('advance_round_{0}'.format(r),
+                    time.perf_counter() - start)
+        return reach
+
+    # Each round's win rates matrix @ reach + byes, the factor advance
+    # multiplies reach by, for readvance_team.
+    def win_rates(self, round_matrices, reach):
+        return [matrix @ reach[r] + self.byes[r]
+            for r, matrix in enumerate(round_matrices)]
+
+    # Recomputes reach after round_matrices changed only in the rows and
+    # columns of the given team indices. Only the slots on those teams' paths
+    # to the championship are evaluated; every other entry is copied from
+    # reach.
+    def readvance(self, reach, round_matrices, changed):
+        profiling.count('readvance')
+        new_reach = [reach[0]]
+        for r in range(self.num_rounds):
+            prev = new_reach[-1]
+            current = reach[r + 1].copy()
+            bounds = self.slot_bounds[r + 1]
+            for slot in np.unique(self.leaves[changed] >> (r + 1)):
+                lo, hi = bounds[slot], bounds[slot + 1]
+                current[lo:hi] = prev[lo:hi] * (round_matrices[r][lo:hi,
+                    lo:hi] @ prev[lo:hi] + self.byes[r][lo:hi])
+            new_reach.append(current)
+        return new_reach
+
+    # Reach after team i's win probabilities become row (and its column the
+    # complement), from the reach, round matrices and win rates before the
+    # change, which are left untouched. In each round only i's slot moves:
+    # the teams in i's half keep their win rates, i gets its new one, and the
+    # other half's rates shift by their probabilities against i's half times
+    # its change in reach. Each round costs one half-by-half product instead
+    # of a copy of the matrix.
+    def readvance_team(self, reach, round_matrices, win_rates, i, row):
+        profiling.count('readvance')
+        new_reach = [reach[0]]
+        leaf = int(self.leaves[i])
+        byes = self.byes[:, i]
+        for r, matrix in enumerate(round_matrices):
+            bounds = self.slot_bounds[r]
+            half = leaf >> r
+            lo, hi = bounds[half], bounds[half + 1]
+            other = slice(bounds[half ^ 1], bounds[(half ^ 1) + 1])
+            prev = new_reach[-1]
+            prev_other, row_other = prev[other], row[other]
+            current = reach[r + 1].copy()
+            current[lo:hi] = prev[lo:hi] * win_rates[r][lo:hi]
+            current[i] = prev[i] * (row_other @ prev_other + byes[r])
+            current[other] += prev_other * (matrix[other, lo:hi] @
+                (prev[lo:hi] - reach[r][lo:hi]) +
+                (matrix[i, other] - row_other) * prev[i])
+            new_reach.append(current)
+        return new_reach
+
+    def expected_scores(self, reach):
+        return self.banked + self.scoring @ np.array(reach[1:])
+
+    # Reverse pass through advance. seeds is a (k, teams) array of weights on
+    # the expected scores and each of tangents a (teams, teams) array of
+    # derivatives of the win probability matrix's entries with respect to a
+    # parameter of their row or column team. For each tangent returns the
+    # (k, teams) gradients of the weighted sums contracted with it over the
+    # matrix's columns and over its rows. Each round is contracted as it is
+    # visited, so nothing larger than (k, teams) is kept across rounds.
+    def backpropagate(self, reach, round_matrices, seeds, tangents):
+        seeds = np.atleast_2d(seeds)
+        by_row = [np.zeros(seeds.shape) for _ in tangents]
+        by_column = [np.zeros(seeds.shape) for _ in tangents]
+        grad_reach = self.scoring[-1] * seeds
+        for r in reversed(range(self.num_rounds)):
+            prev = reach[r]
+            matrix = round_matrices[r]
+            weighted = grad_reach * prev
+            for t, tangent in enumerate(tangents):
+                masked = self.round_masks[r] * tangent
+                by_row[t] += weighted * (masked @ prev)
+                by_column[t] += (weighted @ masked) * prev
+            grad_reach = grad_reach * (matrix @ prev + self.byes[r]) + \
+                    weighted @ matrix
+            if r:
+                grad_reach += self.scoring[r - 1] * seeds
+        return list(zip(by_row, by_column))
+
+    # Exact second moments E[S_i S_j] of the teams' scores (leaving out banked
+    # points) in one forward pass over the rounds. Two teams that would meet
+    # in round m score independently before it, and after it at most one of
+    # them goes on, so the cross term only needs, for every team j and every
+    # team k in j's current slot, T[j, k] = E[j's points so far * (k wins the
+    # slot)], which advances slot by slot alongside reach. If team i (from
+    # the other half) wins round m it goes on to score U[m][i] more points on
+    # average, whoever it beat.
+    def second_moments(self, reach, round_matrices):
+        num_teams = len(self.teams)
+        wins = [matrix @ reach[r] + self.byes[r]
+            for r, matrix in enumerate(round_matrices)]
+        # points[m] holds each team's expected points before round m
+        points = np.cumsum([np.zeros(num_teams)] + [round_points *
+            reach[r + 1] for r, round_points in enumerate(self.scoring)],
+            axis=0)
+        future = [self.scoring[-1] * np.ones(num_teams)]
+        for r in reversed(range(self.num_rounds - 1)):
+            future.insert(0, self.scoring[r] + wins[r + 1] * future[0])
+
+        moments = np.zeros((num_teams, num_teams))
+        joint = np.zeros((num_teams, num_teams))
+        diagonal = np.arange(num_teams)
+        for r, matrix in enumerate(round_matrices):
+            weight = future[r] * reach[r]
+            bounds = self.slot_bounds[r]
+            for slot in range(0, len(bounds) - 1, 2):
+                top = slice(bounds[slot], bounds[slot + 1])
+                bottom = slice(bounds[slot + 1], bounds[slot + 2])
+                moments[top, bottom] = np.outer(points[r][top],
+                    points[r][bottom]) + weight[top, None] * \
+                        (matrix[top, bottom] @ joint[bottom, bottom].T) + \
+                    (weight[bottom, None] *
+                        (matrix[bottom, top] @ joint[top, top].T)).T
+                moments[bottom, top] = moments[top, bottom].T
+
+                joint[top, bottom] = (joint[top, top] @
+                    matrix[bottom, top].T) * reach[r][bottom]
+                joint[bottom, top] = (joint[bottom, bottom] @
+                    matrix[top, bottom].T) * reach[r][top]
+                joint[top, top] *= wins[r][top]
+                joint[bottom, bottom] *= wins[r][bottom]
+            joint[diagonal, diagonal] += self.scoring[r] * reach[r + 1]
+
+        # winning round t also means winning every round before it
+        earlier = np.concatenate([[0.0], np.cumsum(self.scoring)[:-1]])
+        moments[diagonal, diagonal] = (self.scoring * (self.scoring +
+            2 * earlier)) @ np.array(reach[1:])
+        return moments
+
+    # Plays num_sims whole brackets at once, one array of winner indices per
+    # round, and returns the (num_sims, teams) array of sampled scores.
+    # Forfeits are already folded into win_probs, so every game has a winner.
+    def simulate(self, win_probs, num_sims, rng=None):
+        if rng is None:
+            rng = np.random.default_rng()
+        num_teams = len(self.teams)
+        scores = np.zeros((num_sims, num_teams))
+        flat_scores = scores.reshape(-1)
+        offsets = (np.arange(num_sims) * num_teams)[:, None]
+
+        leaf_bounds = self.slot_bounds[0]
+        winners = np.repeat(leaf_bounds[None, :-1], num_sims, axis=0)
+        for leaf in self.shared_leaves:
+            lo, hi = leaf_bounds[leaf], leaf_bounds[leaf + 1]
+            thresholds = np.cumsum(self.initial[lo:hi])[:-1]
+            draws = rng.random(num_sims)
+            winners[:, leaf] = lo + (draws[:, None] >= thresholds).sum(axis=1)
+        # -1 stands for an empty slot, which loses to anyone
+        winners[:, self.empty_leaves] = -1
+
+        for points in self.scoring:
+            team1, team2 = winners[:, 0::2], winners[:, 1::2]
+            team1_wins = rng.random(team1.shape) < win_probs[team1, team2]
+            if len(self.empty_leaves):
+                team1_wins = (team1_wins | (team2 < 0)) & (team1 >= 0)
+            winners = np.where(team1_wins, team1, team2)
+            if len(self.empty_leaves):
+                flat_scores[(offsets + winners)[winners >= 0]] += points
+            else:
+                flat_scores[offsets + winners] += points
+
+        return scores + self.banked
+
+    def to_dict(self, values, number=Decimal):
+        result = defaultdict(lambda: number(0))
+        for team_name, value in zip(self.teams, values):
+            result[team_name] = number(float(value))
+        return result
+
+
+# Bracket engine for fields too large for BracketEngine's dense teams x teams
+# arrays (pools of thousands of entries). Any two teams meet in exactly one
+# round, so every pair is still evaluated once, but only the games each
+# round can actually hold are ever materialized, a chunk of at most
+# chunk_size pairs at a time, with win probabilities computed from the
+# ratings as the chunk is played. Memory is O(teams * rounds + chunk_size).
+# Byes and banked points work as in BracketEngine.
+class BlockEngine:
+    def __init__(self, bracket, scoring, chunk_size=None, banked=None):
+        teams, leaves, initial = bracket_arrays(bracket)
+        self.teams = teams
+        self.index = dict((team_name, i) for i, team_name in enumerate(teams))
+        self.leaves = np.array(leaves, dtype=int)
+        self.initial = np.array(initial, dtype=float)
+        self.num_leaves = len(bracket)
+        self.num_rounds = self.num_leaves.bit_length() - 1
+        self.scoring = round_scoring(scoring, self.num_rounds)
+        self.banked = banked_array(self.teams, banked)
+        self.slot_bounds = slot_bounds(self.leaves, self.num_leaves)
+        self.byes = bye_rounds(self.leaves, self.slot_bounds)
+        self.chunk_size = chunk_size or BLOCK_CHUNK_SIZE
+
+    # (i, j) index arrays covering every game round r can hold, with team i
+    # from the top half of a slot and team j from the bottom half, in chunks
+    # of roughly chunk_size pairs
+    def round_pairs(self, r):
+        bounds = self.slot_bounds[r]
+        segments = []
+        pending = 0
+        for slot in range(0, len(bounds) - 1, 2):
+            lo, mid, hi = bounds[slot], bounds[slot + 1], bounds[slot + 2]
+            if lo == mid or mid == hi:
+                continue
+            step = max(1, self.chunk_size // (hi - mid))
+            for start in range(lo, mid, step):
+                stop = min(start + step, mid)
+                segments.append((start, stop, mid, hi))
+                pending += (stop - start) * (hi - mid)
+                if pending >= self.chunk_size:
+                    yield expand_segments(segments)
+                    segments = []
+                    pending = 0
+        if segments:
+            yield expand_segments(segments)
+
+    # overrides as sorted i * teams + j keys (both orientations) and the
+    # matching probabilities that team i beats team j
+    def compile_overrides(self, overrides):
+        if not overrides:
+            return None
+        rows, cols, probs = overrides.compile(self.index)
+        num_teams = len(self.teams)
+        keys = np.concatenate([rows * num_teams + cols, cols * num_teams + rows])
+        values = np.concatenate([probs, 1 - probs])
+        order = np.argsort(keys)
+        return keys[order], values[order]
+
+    # Same model as calculate_win_probs for the pairs (i[k], j[k]), using the
+    # reduced form of the z-score (tempo cancels out, see
+    # win_prob_matrix_gradients), which matters at hundreds of millions of
+    # pairs.
+    def pair_probs(self, ratings, i, j, overrides=None, forfeit_prob=0.0):
+        offense, defense = ratings['offense'], ratings['defense']
+        team1_scoring = 1 + offense[i] + defense[j]
+        team2_scoring = 1 + offense[j] + defense[i]
+        scale = 2 * float(AVG_SCORING / 100) * float(AVG_TEMPO) / \
+                float(SCORING_STDDEV)
+        z = scale * (team1_scoring - team2_scoring) / \
+                (team1_scoring + team2_scoring)
+
+        forfeit_win_prob = forfeit_prob * (1.0 - forfeit_prob)
+        forfeit_tie_prob = forfeit_prob * forfeit_prob
+        game_play_prob = 1.0 - (2 * forfeit_win_prob + forfeit_tie_prob)
+        probs = forfeit_win_prob + (0.5 * forfeit_tie_prob) + \
+                game_play_prob * ndtr(z)
+        if overrides is not None and len(overrides[0]):
+            keys, values = overrides
+            pair_keys = i * len(self.teams) + j
+            found = np.minimum(np.searchsorted(keys, pair_keys), len(keys) - 1)
+            hit = keys[found] == pair_keys
+            probs[hit] = values[found[hit]]
+            profiling.count('override_hits', int(hit.sum()))
+        return probs
+
+    # reach as in BracketEngine.advance, for a structured array of the teams'
+    # ratings and overrides from compile_overrides
+    def advance(self, ratings, overrides=None, forfeit_prob=0.0):
+        num_teams = len(self.teams)
+        reach = [self.initial]
+        for r in range(self.num_rounds):
+            if profiling.ENABLED:
+                start = time.perf_counter()
+            prev = reach[-1]
+            wins = np.zeros(num_teams)
+            for i, j in self.round_pairs(r):
+                probs = self.pair_probs(ratings, i, j, overrides, forfeit_prob)
+                wins += np.bincount(i, probs * prev[j], num_teams)
+                wins += np.bincount(j, (1 - probs) * prev[i], num_teams)
+            reach.append(prev * (wins + self.byes[r]))
+            if profiling.ENABLED:
+                profiling.record('advance_round_{0}'.format(r),
+                    time.perf_counter() - start)
+        return reach
+
+    def expected_scores(self, reach):
+        return self.banked + self.scoring @ np.array(reach[1:])
+
+    def to_dict(self, values, number=Decimal):
+        return BracketEngine.to_dict(self, values, number)
+
+
+# (i, j) pairs for (row start, row stop, column start, column stop) blocks
+def expand_segments(segments):
+    row_start, row_stop, col_start, col_stop = np.array(segments).T
+    cols = col_stop - col_start
+    sizes = (row_stop - row_start) * cols
+    segment = np.repeat(np.arange(len(segments)), sizes)
+    offset = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    return (row_start[segment] + offset // cols[segment],
+        col_start[segment] + offset % cols[segment])
+
+
+# teams, leaf positions and leaf (play-in) probabilities of a bracket, in
+# bracket order
+def bracket_arrays(bracket):
+    teams = []
+    leaves = []
+    initial = []
+    for leaf, game in enumerate(bracket):
+        for team_name, win_prob in game.items():
+            teams.append(team_name)
+            leaves.append(leaf)
+            initial.append(float(win_prob))
+    return teams, leaves, initial
+
+
+# slot_bounds[r] holds the index ranges of the slots filled after r rounds
+# (slot_bounds[0] are the leaves)
+def slot_bounds(leaves, num_leaves):
+    num_rounds = num_leaves.bit_length() - 1
+    return [np.searchsorted(leaves, np.arange(0, num_leaves + 1, 2 ** r))
+        for r in range(num_rounds + 1)]
+
+
+def round_scoring(scoring, num_rounds):
+    if len(scoring) < num_rounds:
+        raise ValueError('a {0} round bracket needs {0} round scores, got '
+            '{1}'.format(num_rounds, len(scoring)))
+    return np.array([float(points) for points in scoring[:num_rounds]])
+
+
+# byes[r][i] is 1 where the other half of team i's round r slot holds no
+# teams, so team i advances through round r unopposed
+def bye_rounds(leaves, bounds):
+    byes = np.zeros((len(bounds) - 1, len(leaves)))
+    for r in range(len(bounds) - 1):
+        sibling = (leaves >> r) ^ 1
+        byes[r] = bounds[r][sibling] == bounds[r][sibling + 1]
+    return byes
+
+
+def banked_array(teams, banked):
+    if not banked:
+        return np.zeros(len(teams))
+    return np.array([float(banked.get(team_name, 0)) for team_name in teams])
+
+
+CollapsedBracket = namedtuple('CollapsedBracket', ['bracket', 'scoring',
+    'banked', 'eliminated', 'round_offset', 'unplayed'])
+
+# Plays results (a dict of frozenset({team1, team2}) -> winner) into bracket.
+# The returned bracket starts at the first round that still has an undecided
+# game (round_offset rounds in, with scoring trimmed to match): every slot
+# decided by then holds just its winner, and slots whose winner has since
+# been eliminated are left empty, which gives the surviving opponent a bye.
+# banked holds the points each team earned in rounds that are no longer in
+# the bracket (every round, for eliminated teams) and unplayed the results
+# whose game the bracket has not reached.
+def collapse_bracket(bracket, scoring, results, number=Decimal):
+    num_rounds = len(bracket).bit_length() - 1
+    used = set()
+    eliminated = set()
+    rounds_won = defaultdict(list)
+
+    # each slot holds its winner's name, or None while undecided
+    slots = []
+    for game in bracket:
+        winner = None
+        if len(game) == 1:
+            winner, = game
+        for name1 in game:
+            for name2 in game:
+                key = frozenset((name1, name2))
+                if name1 < name2 and key in results:
+                    used.add(key)
+                    winner = results[key]
+                    eliminated.update(key - set([winner]))
+        slots.append(winner)
+
+    levels = [slots]
+    for r in range(num_rounds):
+        slots = []
+        for team1, team2 in zip(levels[-1][0::2], levels[-1][1::2]):
+            key = frozenset((team1, team2))
+            winner = None
+            if team1 is not None and team2 is not None and key in results:
+                used.add(key)
+                winner = results[key]
+                eliminated.update(key - set([winner]))
+                rounds_won[winner].append(r)
+            slots.append(winner)
+        levels.append(slots)
+
+    round_offset = 0
+    while round_offset < num_rounds - 1 and \
+            all(slot is not None for slot in levels[round_offset + 1]):
+        round_offset += 1
 
-    prob = calculate_win_prob(team1, team2, overrides)
-    winner = team_name1 if random.random() < prob else team_name2
+    if round_offset:
+        new_bracket = [{} if name in eliminated else {name: number(1)}
+            for name in levels[round_offset]]
+    else:
+        new_bracket = [dict((name, prob) for name, prob in game.items()
+                if name not in eliminated) if winner is None else
+            {} if winner in eliminated else {winner: number(1)}
+            for game, winner in zip(bracket, levels[0])]
 
-    return { winner : Decimal(1) }
+    banked = {}
+    for name, won in rounds_won.items():
+        points = [scoring[r] for r in won
+            if r < round_offset or name in eliminated]
+        if points:
+            banked[name] = sum(points)
+
+    return CollapsedBracket(
+        bracket=new_bracket,
+        scoring=scoring[round_offset:],
+        banked=banked,
+        eliminated=eliminated,
+        round_offset=round_offset,
+        unplayed=[(winner, next(iter(key - set([winner]))))
+            for key, winner in results.items() if key not in used])
 
 
 class TournamentState:
-    def __init__(self, bracket, ratings, scoring, overrides=OverridesMap(), forfeit_prob=0.0):
+    def __init__(self, bracket, ratings, scoring, overrides=None, forfeit_prob=0.0,
+            backend='float', results=None):
         self.bracket = bracket
         self.ratings = ratings
         self.scoring = scoring
-        self.overrides = overrides
+        self.overrides = overrides if overrides is not None else OverridesMap()
         self.forfeit_prob = forfeit_prob
+        self.backend = backend
+        self.number = BACKENDS[backend]
+        # the bracket and scoring as given; bracket and scoring above are
+        # replaced by their collapsed forms once results come in
+        self.full_bracket = bracket
+        self.full_scoring = scoring
+        self.results = {}
+        self.round_offset = 0
+        self.banked = {}
+        self.eliminated = set()
+        if results:
+            self.apply_results(results)
+        else:
+            self._build_engine()
+
+    def _build_engine(self):
+        if sum(len(game) for game in self.bracket) <= DENSE_MAX_TEAMS:
+            self.engine = BracketEngine(self.bracket, self.scoring, self.banked)
+        else:
+            self.engine = BlockEngine(self.bracket, self.scoring,
+                banked=self.banked)
+        self._team_ids = None
+        self._cache_key = None
+        self._win_probs = None
+        self._overridden = None
+        self._round_matrices = None
+        self._reach = None
+        self._win_rates = None
+
+    # Plays (winner, loser) results into the bracket (see collapse_bracket):
+    # decided slots collapse to their winner, completed rounds are dropped
+    # with their points banked and eliminated teams leave the engine's arrays,
+    # so every later evaluation only covers what is still undecided. Results
+    # accumulate across calls. Returns the results whose game the bracket has
+    # not reached yet.
+    def apply_results(self, rows):
+        for winner, loser in rows:
+            self.results[frozenset((winner, loser))] = winner
+        collapsed = collapse_bracket(self.full_bracket, self.full_scoring,
+            self.results, self.number)
+        self.bracket = collapsed.bracket
+        self.scoring = collapsed.scoring
+        self.banked = collapsed.banked
+        self.eliminated = collapsed.eliminated
+        self.round_offset = collapsed.round_offset
+        self._build_engine()
+        profiling.count('results_applied', len(self.results))
+        return collapsed.unplayed
+
+    # scores from the engine, plus the banked points of eliminated teams
+    def _to_dict(self, values):
+        result = self.engine.to_dict(values, self.number)
+        for team_name in self.eliminated:
+            result[team_name] = self.number(float(self.banked.get(team_name,
+                0)))
+        return result
+
+    # everything the probability matrix depends on; ratings may be swapped or
+    # edited and overrides added or removed between calls
+    def fingerprint(self):
+        if isinstance(self.ratings, Ratings):
+            team_ratings = (id(self.ratings), self.ratings.revision)
+        else:
+            team_ratings = tuple((team.offense, team.defense, team.tempo)
+                for team in (self.ratings[name] for name in self.engine.teams))
+        return (team_ratings, id(self.overrides), self.overrides.revision,
+            self.forfeit_prob, AVG_SCORING, AVG_TEMPO, SCORING_STDDEV)
+
+    # Structured array of the bracket teams' ratings, in engine order. Rows
+    # of a Ratings array that were never set are zeros, so every bracket
+    # team is checked against ratings whenever they change; a missing one
+    # raises KeyError.
+    def team_ratings(self):
+        if not isinstance(self.ratings, Ratings):
+            return rating_array([self.ratings[name]
+                for name in self.engine.teams])
+        key = (id(self.ratings), self.ratings.revision)
+        if self._team_ids is None or self._team_ids[0] != key:
+            missing = [name for name in self.engine.teams
+                if name not in self.ratings]
+            if missing:
+                raise KeyError('no ratings for ' + ', '.join(missing))
+            self._team_ids = (key,
+                self.ratings.registry.lookup(self.engine.teams))
+        return self.ratings.array[self._team_ids[1]]
+
+    def _refresh(self):
+        key = self.fingerprint()
+        if key != self._cache_key:
+            profiling.count('state_refreshes')
+            if isinstance(self.engine, BlockEngine):
+                engine = self.engine
+                self._reach = engine.advance(self.team_ratings(),
+                    engine.compile_overrides(self.overrides),
+                    self.forfeit_prob)
+                self._cache_key = key
+                return
+            self._win_probs = model_win_prob_matrix(self.team_ratings(),
+                self.forfeit_prob)
+            self._overridden = apply_overrides(self._win_probs,
+                self.engine.index, self.overrides)
+            self._round_matrices = self.engine.round_matrices(self._win_probs)
+            self._reach = self.engine.advance(self._round_matrices)
+            self._win_rates = None
+            self._cache_key = key
+
+    def _require_dense(self):
+        if isinstance(self.engine, BlockEngine):
+            raise ValueError('a field of {0} teams uses BlockEngine, which only '
+                'supports expected scores; BracketEngine supports everything '
+                'for fields of at most {1} teams'.format(
+                len(self.engine.teams), DENSE_MAX_TEAMS))
+
+    def win_prob_matrix(self):
+        self._require_dense()
+        self._refresh()
+        return self._win_probs
+
+    # entries of win_prob_matrix that come from overrides
+    def override_mask(self):
+        self._require_dense()
+        self._refresh()
+        return self._overridden
+
+    def expected_scores(self):
+        self._refresh()
+        return self.engine.expected_scores(self._reach)
+
+    # Applies (name1, name2, prob) rows to overrides, where a prob of None
+    # removes the override, and patches the cached matrix and reach in place
+    # instead of rebuilding them. Only the slots above the changed matchups
+    # are recomputed. A play-in (two teams sharing a leaf) is decided before
+    # the first round, so its new probability goes into the engine's initial
+    # reach and the bracket game instead. Returns the engine indices of the
+    # teams involved.
+    def update_overrides(self, rows):
+        self._require_dense()
+        self._refresh()
+        rows = list(rows)
+        for name1, name2, prob in rows:
+            if prob is None:
+                self.overrides.remove_override(name1, name2)
+            else:
+                self.overrides.add_override(name1, name2, prob)
+
+        engine = self.engine
+        index = engine.index
+        pairs = [(index[name1], index[name2], prob)
+            for name1, name2, prob in rows
+            if name1 in index and name2 in index]
+        if pairs:
+            ratings = self.team_ratings()
+            play_ins = []
+            for i, j, prob in pairs:
+                self._overridden[i, j] = self._overridden[j, i] = \
+                    prob is not None
+                if prob is None:
+                    prob = calculate_win_probs(ratings['offense'][i],
+                        ratings['defense'][i], ratings['tempo'][i],
+                        ratings['offense'][j], ratings['defense'][j],
+                        ratings['tempo'][j], self.forfeit_prob)
+                self._win_probs[i, j] = float(prob)
+                self._win_probs[j, i] = 1 - float(prob)
+                masks = engine.round_masks[:, [i, j], [j, i]]
+                self._round_matrices[:, [i, j], [j, i]] = \
+                    masks * self._win_probs[[i, j], [j, i]]
+                if engine.leaves[i] == engine.leaves[j]:
+                    play_ins.append((i, j, prob))
+            reach = self._reach
+            if play_ins:
+                initial = engine.initial.copy()
+                for i, j, prob in play_ins:
+                    initial[i] = self._win_probs[i, j]
+                    initial[j] = self._win_probs[j, i]
+                    self._set_play_in(engine.teams[i], engine.teams[j], prob)
+                engine.initial = initial
+                reach = [initial] + reach[1:]
+            changed = sorted(set(i for pair in pairs for i in pair[:2]))
+            self._reach = engine.readvance(reach, self._round_matrices,
+                changed)
+            self._win_rates = None
+        else:
+            changed = []
+        self._cache_key = self.fingerprint()
+        return changed
+
+    # Recomputes the undecided play-ins from the current ratings and
+    # overrides, as read_games_from_file does, e.g. after ratings were
+    # reloaded: the bracket games and the engine's initial reach take the
+    # new probabilities. Returns the number of play-ins that changed.
+    def update_play_ins(self):
+        engine = self.engine
+        initial = engine.initial.copy()
+        changed = 0
+        for game in list(self.bracket):
+            if len(game) != 2:
+                continue
+            name1, name2 = game
+            prob = calculate_win_prob(self.ratings[name1], self.ratings[name2],
+                self.overrides)
+            if prob == game[name1]:
+                continue
+            self._set_play_in(name1, name2, prob)
+            initial[engine.index[name1]] = float(prob)
+            initial[engine.index[name2]] = 1 - float(prob)
+            changed += 1
+        if changed:
+            engine.initial = initial
+            self._cache_key = None
+        return changed
+
+    # Replaces the play-in game between name1 and name2 in the bracket (and
+    # in the uncollapsed bracket) with one name1 wins with probability prob,
+    # so engines rebuilt from it and the dict path agree with the engine.
+    # The lists are copied rather than changed under the caller.
+    def _set_play_in(self, name1, name2, prob):
+        prob = self.number(prob)
+        def replace(bracket):
+            return [dict((name, prob if name == name1 else
+                    self.number(1) - prob) for name in game)
+                if len(game) == 2 and name1 in game and name2 in game
+                else game for game in bracket]
+        same = self.bracket is self.full_bracket
+        self.full_bracket = replace(self.full_bracket)
+        self.bracket = self.full_bracket if same else replace(self.bracket)
+
+    # Expected scores if team (a Team with the name of a bracket team) were
+    # swapped into ratings. Only that team's row and column of the matrix
+    # and the slots on its path are recomputed; the cached state is untouched.
+    def expected_scores_with(self, team):
+        self._require_dense()
+        self._refresh()
+        i = self.engine.index[team.name]
+        row = replace_team_row(self._win_probs, self._overridden, i,
+            team_win_probs(team, self.team_ratings(), self.forfeit_prob))
+        return self.engine.expected_scores(self._readvance_team(i, row))
+
+    # reach with team i's row of the matrix replaced (see readvance_team)
+    def _readvance_team(self, i, row):
+        if self._win_rates is None:
+            self._win_rates = self.engine.win_rates(self._round_matrices,
+                self._reach)
+        return self.engine.readvance_team(self._reach, self._round_matrices,
+            self._win_rates, i, row)
+
+    def calculate_scores_with(self, team):
+        return self._to_dict(self.expected_scores_with(team))
+
+    # Games whose two participants are both known but whose result is not,
+    # as (team1, team2, round) tuples in bracket order.
+    def pending_games(self, tolerance=1e-9):
+        self._refresh()
+        engine = self.engine
+        games = []
+        for r in range(engine.num_rounds):
+            known = self._reach[r] >= 1 - tolerance
+            decided = self._reach[r + 1] >= 1 - tolerance
+            bounds = engine.slot_bounds[r]
+            for slot in range(0, len(bounds) - 1, 2):
+                lo, mid, hi = bounds[slot], bounds[slot + 1], bounds[slot + 2]
+                if decided[lo:hi].any():
+                    continue
+                team1 = np.flatnonzero(known[lo:mid])
+                team2 = np.flatnonzero(known[mid:hi])
+                if len(team1) and len(team2):
+                    games.append((engine.teams[lo + team1[0]],
+                        engine.teams[mid + team2[0]], r))
+        return games
+
+    # Expected scores with each game forced both ways. games is a list of
+    # (team1, team2) pairs (by default every pending game); returns two
+    # (games, teams) arrays of scores if team1 wins and if team2 wins. Each
+    # outcome only recomputes the slots above the forced matchup.
+    def game_outcome_scores(self, games=None):
+        self._require_dense()
+        self._refresh()
+        if games is None:
+            games = [game[:2] for game in self.pending_games()]
+        index = self.engine.index
+        win_scores = np.zeros((len(games), len(index)))
+        loss_scores = np.zeros((len(games), len(index)))
+        for g, (team1, team2) in enumerate(games):
+            i, j = index[team1], index[team2]
+            for scores, prob in ((win_scores, 1.0), (loss_scores, 0.0)):
+                row = self._win_probs[i].copy()
+                row[j] = prob
+                scores[g] = self.engine.expected_scores(
+                    self._readvance_team(i, row))
+        return win_scores, loss_scores
+
+    # Expected scores under every combination of outcomes of the given
+    # pending games ((team1, team2) pairs, by default all of them). Returns
+    # (outcomes, probs, scores): outcomes is a (2^k, k) bool array, True where
+    # team1 wins game k; probs the probability of each scenario; scores the
+    # (2^k, teams) expected scores. Scenarios are advanced together as rows of
+    # one reach array, starting from the earliest game's round, and only the
+    # slots above the given games are recomputed. Every other slot (and every
+    # earlier round) is shared from the cached reach.
+    def scenario_scores(self, games=None, max_games=None):
+        self._require_dense()
+        self._refresh()
+        engine = self.engine
+        max_games = max_games or MAX_SCENARIO_GAMES
+        pending = dict(((team1, team2), r)
+            for team1, team2, r in self.pending_games())
+        if games is None:
+            games = list(pending)
+        if len(games) > max_games:
+            raise ValueError('{0} games make {1} scenarios (at most {2} '
+                'games allowed)'.format(len(games), 2 ** len(games), max_games))
+
+        forced = []
+        for team1, team2 in games:
+            r = pending.get((team1, team2), pending.get((team2, team1)))
+            if r is None:
+                raise ValueError('{0} vs. {1} is not a pending game'.format(
+                    team1, team2))
+            forced.append((r, engine.index[team1], engine.index[team2]))
+
+        num_games = len(forced)
+        outcomes = (np.arange(2 ** num_games)[:, None] >>
+            np.arange(num_games)[None, :]) & 1 == 1
+        win_probs = self._win_probs
+        game_probs = np.array([win_probs[i, j] for _, i, j in forced])
+        probs = np.prod(np.where(outcomes, game_probs, 1 - game_probs), axis=1)
+
+        base = self._reach
+        scores = np.tile(engine.expected_scores(base), (len(outcomes), 1))
+        if not forced:
+            return outcomes, probs, scores
+
+        first_round = min(r for r, _, _ in forced)
+        reach = np.tile(base[first_round], (len(outcomes), 1))
+        for r in range(first_round, engine.num_rounds):
+            new_reach = np.tile(base[r + 1], (len(outcomes), 1))
+            bounds = engine.slot_bounds[r + 1]
+            leaves = [engine.leaves[i] for game_round, i, _ in forced
+                if game_round < r]
+            for slot in np.unique(np.array(leaves, dtype=int) >> (r + 1)):
+                lo, hi = bounds[slot], bounds[slot + 1]
+                matrix = np.where(engine.meet_round[lo:hi, lo:hi] == r,
+                    win_probs[lo:hi, lo:hi], 0.0)
+                new_reach[:, lo:hi] = reach[:, lo:hi] * \
+                    (reach[:, lo:hi] @ matrix.T + engine.byes[r][lo:hi])
+            for g, (game_round, i, j) in enumerate(forced):
+                if game_round == r:
+                    new_reach[:, i] = outcomes[:, g]
+                    new_reach[:, j] = ~outcomes[:, g]
+            scores += engine.scoring[r] * (new_reach - base[r + 1])
+            reach = new_reach
+
+        return outcomes, probs, scores
+
+    # Exact derivatives of seeds @ expected scores with respect to each
+    # bracket team's (adjusted) offense and defense, from one reverse pass.
+    # seeds defaults to the identity, giving d_offense[i, k] =
+    # d(score of team i)/d(offense of team k). Overridden matchups do not
+    # depend on ratings.
+    def rating_sensitivities(self, seeds=None):
+        self._require_dense()
+        self._refresh()
+        if seeds is None:
+            seeds = np.eye(len(self.engine.teams))
+        grad_scoring1, grad_scoring2 = win_prob_matrix_gradients(
+            self.team_ratings(), self.forfeit_prob)
+        grad_scoring1[self._overridden] = 0.0
+        grad_scoring2[self._overridden] = 0.0
+        (row1, column1), (row2, column2) = self.engine.backpropagate(
+            self._reach, self._round_matrices, seeds,
+            [grad_scoring1, grad_scoring2])
+
+        # in matchup (i, j) team i's offense and team j's defense drive team
+        # i's scoring rate, team j's offense and team i's defense drive team j's
+        d_offense = row1 + column2
+        d_defense = row2 + column1
+        return d_offense, d_defense
+
+    def simulate_scores(self, num_sims, rng=None):
+        self._require_dense()
+        self._refresh()
+        profiling.count('simulations', num_sims)
+        with profiling.timer('simulate'):
+            return self.engine.simulate(self._win_probs, num_sims, rng)
+
+    # yields sampled score arrays in chunks so large runs stay in memory
+    def iter_simulated_scores(self, num_sims, chunk_size=100000, rng=None):
+        if rng is None:
+            rng = np.random.default_rng()
+        for start in range(0, num_sims, chunk_size):
+            yield self.simulate_scores(min(chunk_size, num_sims - start), rng)
+
+    # Covariance matrix of the teams' final scores: exact (see
+    # BracketEngine.second_moments), or with num_sims estimated from that
+    # many simulated brackets around the exact expected scores, one chunk of
+    # simulations at a time
+    def score_covariance(self, num_sims=None, chunk_size=100000, rng=None):
+        self._require_dense()
+        mean = self.expected_scores()
+        if num_sims is None:
+            profiling.count('score_covariances')
+            mean = mean - self.engine.banked
+            moments = self.engine.second_moments(self._reach,
+                self._round_matrices)
+            return moments - np.outer(mean, mean)
+
+        covariance = np.zeros((len(mean), len(mean)))
+        for scores in self.iter_simulated_scores(num_sims, chunk_size, rng):
+            scores -= mean
+            covariance += scores.T @ scores
+        return covariance / num_sims
+
+    # game_transform (or the decimal backend) selects the original
+    # dict-walking evaluator; otherwise scores come from the array engine,
+    # adapted to the same dict output
+    def calculate_scores(self, game_transform=None):
+        if game_transform is None and self.backend == 'decimal':
+            game_transform = game_transform_prob
+        if game_transform is None:
+            return self._to_dict(self.expected_scores())
 
-    def calculate_scores(self, game_transform=game_transform_prob):
         tourney_round = 0
         games = list(self.bracket)
-        total_scores = defaultdict(lambda: Decimal(0))
+        total_scores = defaultdict(int)
+        for team_name, points in self.banked.items():
+            total_scores[team_name] += points
         while len(games) > 1:
             new_games = []
+            if profiling.ENABLED:
+                start = time.perf_counter()
             for i in range(len(games) // 2):
                 child1, child2 = games[2 * i: 2 * i + 2]
                 parent = game_transform(child1, child2, self.ratings,
@@ -146,6 +1142,9 @@ class TournamentState:
                 new_games.append(parent)
 
             games = new_games
+            if profiling.ENABLED:
+                profiling.record('calculate_scores_round_{0}'.format(
+                    tourney_round), time.perf_counter() - start)
             tourney_round += 1
 
             if DEBUG_PRINT:
@@ -164,31 +1163,44 @@ class TournamentState:
 
 
     def calculate_scores_prob(self):
-        return self.calculate_scores(game_transform_prob)
+        return self.calculate_scores()
 
 
     def calculate_scores_sim(self):
-        return self.calculate_scores(game_transform_sim)
+        return self._to_dict(self.simulate_scores(1)[0])
+
+    # Checks the array engine against the dict-walking evaluator (which works
+    # in Decimal when the ratings are Decimal) and returns the largest
+    # difference in any team's expected score.
+    def compare_backends(self, tolerance=1e-9):
+        reference = self.calculate_scores(game_transform_prob)
+        values = self.expected_scores()
+        difference = max(abs(float(reference[team_name]) - value)
+            for team_name, value in zip(self.engine.teams, values))
+        if difference > tolerance:
+            raise ValueError('backends differ by {0} (tolerance {1})'.format(
+                difference, tolerance))
+        return difference
 
 
-def read_adjustments_file(in_file):
+def read_adjustments_file(in_file, number=Decimal):
     adjustments = {}
 
     for line in in_file:
         team, adj = tuple(line.strip().split('|'))
         if adj[0] == '+':
             adj = adj[1:]
-        adjustments[team] = Decimal(adj)
+        adjustments[team] = number(adj)
 
     return adjustments
 
 
-def read_ratings_file(in_file, adjustments=None):
-    all_ratings = {}
+def read_ratings_file(in_file, adjustments=None, number=Decimal, registry=None):
+    all_ratings = Ratings(registry)
     for line in in_file:
         fields = line.strip().split('|')
         name = fields[0]
-        ratings = list(map(Decimal, fields[1:]))
+        ratings = list(map(number, fields[1:]))
 
         if adjustments:
             try:
@@ -203,15 +1215,18 @@ def read_ratings_file(in_file, adjustments=None):
     return all_ratings
 
 
-def read_games_from_file(filepath, ratings, overrides=None):
+def read_games_from_file(filepath, ratings, overrides=None, number=Decimal):
+    registry = getattr(ratings, 'registry', REGISTRY)
     games = []
     with open(filepath, "rt") as bracket_file:
         reader = csv.reader(bracket_file)
         for row in reader:
             if not len(row):
                 continue
+            for name in row:
+                registry.intern(name)
             if len(row) == 1:
-                games.append({row[0]: Decimal(1)})
+                games.append({row[0]: number(1)})
             elif len(row) == 2:
                 team1 = ratings[row[0]]
                 team2 = ratings[row[1]]
@@ -223,6 +1238,25 @@ def read_games_from_file(filepath, ratings, overrides=None):
     return games
 
 
+# Completed games as (winner, loser) pairs, from a file in the overrides
+# format (name1,name2,prob) where every prob is 1 or 0.
+def read_results_file(filepath):
+    results = []
+    with open(filepath, "rt") as results_file:
+        for row in csv.reader(results_file):
+            if not row:
+                continue
+            name1, name2, prob = row
+            if Decimal(prob) == 1:
+                results.append((name1, name2))
+            elif Decimal(prob) == 0:
+                results.append((name2, name1))
+            else:
+                raise ValueError('{0} vs. {1} has no result ({2})'.format(
+                    name1, name2, prob))
+    return results
+
+
 # based on old kenpom pythag ratings
 '''
 def calculate_win_prob(team1, team2, overrides=None):
@@ -235,24 +1269,30 @@ def calculate_win_prob(team1, team2, overrides=None):
 '''
 
 def calculate_win_prob(team1, team2, overrides=None, forfeit_prob=0.0):
+    profiling.count('calculate_win_prob')
+    # arithmetic follows the ratings' type (Decimal or float)
+    number = type(team1.offense)
     if overrides:
         override = overrides.get_override(team1.name, team2.name)
         if override is not None:
-            return override
+            return number(override)
 
     if DEBUG_PRINT:
         print('scoring {0}-{1}'.format(team1.name, team2.name))
 
+    avg_scoring = number(AVG_SCORING)
+    avg_tempo = number(AVG_TEMPO)
+
     # number of expected possessions per team
-    tempo = (team1.tempo * team2.tempo) / AVG_TEMPO
+    tempo = (team1.tempo * team2.tempo) / avg_tempo
 
     # teams' points per possession, as percentage of national average
     team1_scoring = 1 + team1.offense + team2.defense
     team2_scoring = 1 + team2.offense + team1.defense
 
     # teams' actual points per possession
-    team1_ppp = team1_scoring * (AVG_SCORING / 100)
-    team2_ppp = team2_scoring * (AVG_SCORING / 100)
+    team1_ppp = team1_scoring * (avg_scoring / 100)
+    team2_ppp = team2_scoring * (avg_scoring / 100)
 
     # expected point differential is difference in per-possession scoring
     # times expected number of possesions per team
@@ -266,7 +1306,7 @@ def calculate_win_prob(team1, team2, overrides=None, forfeit_prob=0.0):
     # deviation in scoring margin should scale (linearly?) based on tempo and
     # possibly also scoring rates
     stddev = ((team1_scoring + team2_scoring) / 2) * \
-            (tempo / AVG_TEMPO) * SCORING_STDDEV
+            (tempo / avg_tempo) * number(SCORING_STDDEV)
     
     # find probability that actual point diff will be positive
     # this is the probability that team 1 will win if the game actually occurs
@@ -278,7 +1318,106 @@ def calculate_win_prob(team1, team2, overrides=None, forfeit_prob=0.0):
     forfeit_tie_prob = forfeit_prob * forfeit_prob
     game_play_prob = 1.0 - (forfeit_win_prob + forfeit_loss_prob + forfeit_tie_prob)
 
-    return Decimal(forfeit_win_prob + (0.5 * forfeit_tie_prob) + (game_play_prob * game_win_prob))
+    return number(forfeit_win_prob + (0.5 * forfeit_tie_prob) + (game_play_prob * game_win_prob))
+
+# Same model as calculate_win_prob, evaluated elementwise over float arrays of
+# ratings so a whole matrix of matchups costs a single norm.cdf call.
+def calculate_win_probs(offense1, defense1, tempo1, offense2, defense2, tempo2,
+        forfeit_prob=0.0):
+    profiling.count('calculate_win_probs')
+    avg_scoring = float(AVG_SCORING)
+    avg_tempo = float(AVG_TEMPO)
+
+    tempo = (tempo1 * tempo2) / avg_tempo
+    team1_scoring = 1 + offense1 + defense2
+    team2_scoring = 1 + offense2 + defense1
+    point_diff = (team1_scoring - team2_scoring) * (avg_scoring / 100) * tempo
+    stddev = ((team1_scoring + team2_scoring) / 2) * \
+            (tempo / avg_tempo) * float(SCORING_STDDEV)
+    game_win_prob = ndtr(point_diff / stddev)
+
+    forfeit_win_prob = forfeit_prob * (1.0 - forfeit_prob)
+    forfeit_tie_prob = forfeit_prob * forfeit_prob
+    game_play_prob = 1.0 - (2 * forfeit_win_prob + forfeit_tie_prob)
+
+    return forfeit_win_prob + (0.5 * forfeit_tie_prob) + \
+            (game_play_prob * game_win_prob)
+
+
+# structured RATING_DTYPE array from a list of Teams
+def rating_array(teams):
+    return np.array([(float(team.offense), float(team.defense),
+        float(team.tempo)) for team in teams], dtype=RATING_DTYPE)
+
+
+# win_probs[i, j] is the probability that team i beats team j under the
+# ratings model alone, for a structured array of ratings
+def model_win_prob_matrix(ratings, forfeit_prob=0.0):
+    offense, defense, tempo = \
+        ratings['offense'], ratings['defense'], ratings['tempo']
+    return calculate_win_probs(offense[:, None], defense[:, None],
+        tempo[:, None], offense[None, :], defense[None, :], tempo[None, :],
+        forfeit_prob)
+
+
+# probability that team beats each entry of a structured array of ratings
+# under the ratings model alone
+def team_win_probs(team, ratings, forfeit_prob=0.0):
+    return calculate_win_probs(float(team.offense), float(team.defense),
+        float(team.tempo), ratings['offense'], ratings['defense'],
+        ratings['tempo'], forfeit_prob)
+
+
+# team i's row of win_probs with its model probabilities replaced by row,
+# leaving overridden matchups alone
+def replace_team_row(win_probs, overridden, i, row):
+    return np.where(overridden[i], win_probs[i], row)
+
+
+# Partial derivatives of model_win_prob_matrix with respect to each matchup's
+# scoring rates (1 + offense1 + defense2 and 1 + offense2 + defense1). Tempo
+# cancels out of the z-score, which reduces to a ratio of the two rates.
+def win_prob_matrix_gradients(ratings, forfeit_prob=0.0):
+    offense, defense = ratings['offense'], ratings['defense']
+    team1_scoring = 1 + offense[:, None] + defense[None, :]
+    team2_scoring = 1 + offense[None, :] + defense[:, None]
+    total_scoring = team1_scoring + team2_scoring
+
+    scale = 2 * float(AVG_SCORING / 100) * float(AVG_TEMPO) / \
+            float(SCORING_STDDEV)
+    z = scale * (team1_scoring - team2_scoring) / total_scoring
+
+    game_play_prob = 1.0 - (2 * forfeit_prob * (1.0 - forfeit_prob) +
+            forfeit_prob * forfeit_prob)
+    grad_z = game_play_prob * norm.pdf(z) * 2 * scale / total_scoring ** 2
+    return grad_z * team2_scoring, -grad_z * team1_scoring
+
+
+# writes overrides between indexed teams into win_probs and returns the mask
+# of entries they replaced
+def apply_overrides(win_probs, index, overrides):
+    overridden = np.zeros(win_probs.shape, dtype=bool)
+    if not overrides:
+        return overridden
+
+    rows, cols, probs = overrides.compile(index)
+    win_probs[rows, cols] = probs
+    win_probs[cols, rows] = 1 - probs
+    overridden[rows, cols] = overridden[cols, rows] = True
+    overrides.hits += len(probs)
+    profiling.count('override_hits', len(probs))
+
+    return overridden
+
+
+# win_probs[i, j] is the probability that teams[i] beats teams[j], with any
+# overrides between the given teams applied on top of the ratings model
+def build_win_prob_matrix(teams, overrides=None, forfeit_prob=0.0):
+    win_probs = model_win_prob_matrix(rating_array(teams), forfeit_prob)
+    index = dict((team.name, i) for i, team in enumerate(teams))
+    apply_overrides(win_probs, index, overrides)
+    return win_probs
+
 
 def get_bracket_teams(bracket):
     for game in bracket:
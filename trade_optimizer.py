@@ -0,0 +1,242 @@
+from collections import namedtuple
+
+import numpy as np
+
+import portfolio_value as pv
+
+MAX_LEGS = 2
+# baskets of each size that are extended by another leg
+BEAM_WIDTH = 500
+# baskets are ranked by the mean-variance utility
+# expected - risk_aversion / 2 * variance of the portfolio they leave
+RISK_AVERSION = 0.01
+
+# legs is a list of (team, shares) trades, positive shares buying; cost is
+# the cash the basket takes (negative when it raises cash); expected and
+# variance describe the portfolio value once the basket is filled, edge the
+# expected gain over trading at expected scores, and utility the gain in
+# mean-variance utility over the current portfolio, which baskets are
+# ranked by.
+Basket = namedtuple(
+    "Basket", ["legs", "cost", "expected", "variance", "edge", "utility"]
+)
+
+
+def price_vector(prices, teams, default):
+    if prices is None:
+        return default.copy()
+    return np.array(
+        [
+            float(prices[team]) if team in prices else default[i]
+            for i, team in enumerate(teams)
+        ]
+    )
+
+
+# Searches trade baskets against the covariance of the teams' final scores.
+# The expected scores, covariance and current holdings are turned once into
+# the products every evaluation needs, so a batch of baskets, given as (B,
+# legs) arrays of team indices and share counts, is scored with a few array
+# operations:
+#
+#     expected = current + shares . (mean - price)
+#     variance = h'Ch + 2 shares . (Ch) + shares' C shares
+#
+# with h the holdings and C the covariance, which is exact unless num_sims
+# asks for a simulated estimate. buy_prices and sell_prices map teams to the
+# price a bought or sold share trades at (the expected score where missing).
+# Baskets must leave every holding within max_position shares either way and
+# at least min_cash in cash. Baskets are ranked by the mean-variance utility
+# they add, so a trade that takes on risk has to pay for it in edge and one
+# that sheds risk may give up some.
+class TradeOptimizer:
+    def __init__(
+        self,
+        tournament,
+        positions,
+        buy_prices=None,
+        sell_prices=None,
+        covariance=None,
+        num_sims=None,
+        rng=None,
+        max_position=None,
+        min_cash=0.0,
+        risk_aversion=RISK_AVERSION,
+    ):
+        self.teams = tournament.engine.teams
+        self.index = tournament.engine.index
+        self.mean = tournament.expected_scores()
+        if covariance is None:
+            covariance = tournament.score_covariance(num_sims, rng=rng)
+        self.covariance = covariance
+
+        compiled = pv.compile_positions(positions, tournament)
+        self.holdings = compiled.vector
+        self.cash = compiled.cash
+        self.buy_prices = price_vector(buy_prices, self.teams, self.mean)
+        self.sell_prices = price_vector(sell_prices, self.teams, self.mean)
+        self.max_position = max_position
+        self.min_cash = min_cash
+        self.risk_aversion = risk_aversion
+
+        self.risk = self.covariance @ self.holdings
+        self.expected = float(self.mean @ self.holdings + self.cash)
+        self.variance = float(self.holdings @ self.risk)
+
+    # mean-variance utility gained by moving from the current portfolio to
+    # one with the given expected value and variance
+    def utility_gain(self, expected, variance):
+        return (expected - self.expected) - 0.5 * self.risk_aversion * (
+            variance - self.variance
+        )
+
+    # the portfolio as it stands, as an empty basket
+    def current(self):
+        return Basket(
+            legs=[],
+            cost=0.0,
+            expected=self.expected,
+            variance=self.variance,
+            edge=0.0,
+            utility=0.0,
+        )
+
+    # (cost, expected, variance, feasible) arrays for the baskets given by
+    # (B, legs) arrays of team indices and share counts; a basket holds each
+    # team at most once
+    def evaluate(self, indices, shares):
+        prices = np.where(
+            shares > 0, self.buy_prices[indices], self.sell_prices[indices]
+        )
+        cost = (shares * prices).sum(axis=1)
+        expected = self.expected + (shares * self.mean[indices]).sum(axis=1) - cost
+
+        pair_covariance = self.covariance[indices[:, :, None], indices[:, None, :]]
+        variance = (
+            self.variance
+            + 2 * (shares * self.risk[indices]).sum(axis=1)
+            + np.einsum("bk,bkl,bl->b", shares, pair_covariance, shares)
+        )
+
+        feasible = self.cash - cost >= self.min_cash
+        if self.max_position is not None:
+            feasible &= (
+                np.abs(self.holdings[indices] + shares) <= self.max_position
+            ).all(axis=1)
+        return cost, expected, variance, feasible
+
+    def baskets(self, indices, shares, cost, expected, variance):
+        return [
+            Basket(
+                legs=[
+                    (self.teams[i], int(quantity))
+                    for i, quantity in zip(indices[b], shares[b])
+                ],
+                cost=float(cost[b]),
+                expected=float(expected[b]),
+                variance=float(variance[b]),
+                edge=float(expected[b] - self.expected),
+                utility=float(self.utility_gain(expected[b], variance[b])),
+            )
+            for b in range(len(indices))
+        ]
+
+    # Beam search over baskets of up to max_legs trades, each leg buying or
+    # selling one of sizes shares of one of teams (every team by default).
+    # Every single trade is scored, then the beam feasible baskets of each
+    # size that add the most utility are extended by every other leg (even
+    # if they lose utility on their own, as one leg of a hedge may). Returns
+    # the count feasible baskets of any size that add the most utility,
+    # leaving out any that do not improve on the current portfolio.
+    def search(self, sizes, teams=None, max_legs=MAX_LEGS, beam=BEAM_WIDTH, count=10):
+        team_ids = np.array(
+            (
+                [self.index[team] for team in teams if team in self.index]
+                if teams is not None
+                else range(len(self.teams))
+            ),
+            dtype=int,
+        )
+        sizes = np.array(sizes, dtype=float)
+        leg_index = np.repeat(team_ids, 2 * len(sizes))
+        leg_shares = np.tile(np.concatenate([sizes, -sizes]), len(team_ids))
+
+        indices, shares = leg_index[:, None], leg_shares[:, None]
+        best = []
+        for legs in range(1, max_legs + 1):
+            if legs > 1:
+                indices, shares = extend_baskets(indices, shares, leg_index, leg_shares)
+            if not len(indices):
+                break
+            cost, expected, variance, feasible = self.evaluate(indices, shares)
+            gain = self.utility_gain(expected, variance)
+            ranked = np.flatnonzero(feasible)
+            ranked = ranked[np.argsort(-gain[ranked])]
+            improving = ranked[gain[ranked] > 0][:count]
+            best += self.baskets(
+                indices[improving],
+                shares[improving],
+                cost[improving],
+                expected[improving],
+                variance[improving],
+            )
+            indices, shares = indices[ranked[:beam]], shares[ranked[:beam]]
+
+        best.sort(key=lambda basket: -basket.utility)
+        return best[:count]
+
+
+# Every basket extended by every leg on a team it does not already hold,
+# with baskets that only differ in the order of their legs reduced to one
+def extend_baskets(indices, shares, leg_index, leg_shares):
+    num_baskets, num_legs = len(indices), len(leg_index)
+    indices = np.concatenate(
+        [
+            np.repeat(indices, num_legs, axis=0),
+            np.tile(leg_index, num_baskets)[:, None],
+        ],
+        axis=1,
+    )
+    shares = np.concatenate(
+        [
+            np.repeat(shares, num_legs, axis=0),
+            np.tile(leg_shares, num_baskets)[:, None],
+        ],
+        axis=1,
+    )
+    distinct = (indices[:, :-1] != indices[:, -1:]).all(axis=1)
+    indices, shares = indices[distinct], shares[distinct]
+
+    order = np.argsort(indices, axis=1)
+    indices = np.take_along_axis(indices, order, axis=1)
+    shares = np.take_along_axis(shares, order, axis=1)
+    _, unique = np.unique(
+        np.concatenate([indices, shares], axis=1), axis=0, return_index=True
+    )
+    unique.sort()
+    return indices[unique], shares[unique]
+
+
+def print_baskets(current, baskets):
+    print(
+        "current: value {0:.2f}, sd {1:.2f}".format(
+            current.expected, np.sqrt(current.variance)
+        )
+    )
+    if not baskets:
+        print("no improving trade")
+    for basket in baskets:
+        print(
+            "{0}: cost {1:.2f}, value {2:.2f} ({3:+.2f}), sd {4:.2f} ({5:+.2f}), "
+            "utility {6:+.2f}".format(
+                ", ".join(
+                    "{0} {1:+d}".format(team, shares) for team, shares in basket.legs
+                ),
+                basket.cost,
+                basket.expected,
+                basket.edge,
+                np.sqrt(basket.variance),
+                np.sqrt(basket.variance) - np.sqrt(current.variance),
+                basket.utility,
+            )
+        )